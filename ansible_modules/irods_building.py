@@ -6,8 +6,30 @@ import itertools
 import json
 import os
 import shutil
+import tempfile
+import threading
 
 
+class BackgroundTask(threading.Thread):
+    def __init__(self, target, *args):
+        super(BackgroundTask, self).__init__()
+        self.target = target
+        self.args = args
+        self.exception = None
+        self.daemon = True
+        self.start()
+
+    def run(self):
+        try:
+            self.target(*self.args)
+        except BaseException as e:
+            self.exception = e
+
+    def wait(self):
+        self.join()
+        if self.exception is not None:
+            raise self.exception
+
 class UnimplementedStrategy(object):
     def __init__(self, module):
         self.module = module
@@ -48,8 +70,13 @@ class GenericStrategy(object):
         self.debug_build = module.params['debug_build']
         self.local_irods_git_dir = os.path.expanduser('~/irods')
         self.local_irods_build_dir = os.path.expanduser('~/build-irods')
+        self.local_icommands_git_dir = '/home/irodsbuild/irods_client_icommands'
+        self.local_icommands_build_dir = '/home/irodsbuild/icommands_build'
         self.git_repository_icommands = module.params['git_repository_icommands']
         self.git_commitish_icommands = module.params['git_commitish_icommands']
+        self.build_jobs = module.params['build_jobs'] or get_build_parallelism()
+        self.artifact_cache_root_directory = module.params['artifact_cache_root_directory']
+        self.use_ccache = False
 
     @abc.abstractproperty
     def building_dependencies(self):
@@ -63,6 +90,15 @@ class GenericStrategy(object):
         self.install_building_dependencies()
         git_clone(self.git_repository, self.git_commitish, self.local_irods_git_dir)
         self.build_irods_packages()
+        self.publish_irods_packages()
+
+    def publish_irods_packages(self):
+        local_repository_directory = get_local_package_repository_directory(self.artifact_cache_root_directory)
+        if local_repository_directory is None:
+            return
+        packages = glob.glob(os.path.join(self.output_directory, '*.{0}'.format(get_package_suffix())))
+        if packages:
+            publish_to_local_package_repository(packages, local_repository_directory)
 
     def install_building_dependencies(self):
         install_os_packages(self.building_dependencies)
@@ -79,33 +115,102 @@ class GenericStrategy(object):
             self.build_irods_packages_cmake()
         finally:
             for f in itertools.chain(glob.glob(os.path.join(self.local_irods_build_dir, '*.{0}'.format(get_package_suffix()))),
-                                     glob.glob(os.path.join(self.local_irods_build_dir, '*.output'))):
+                                     glob.glob(os.path.join(self.local_irods_build_dir, '*.output')),
+                                     glob.glob(os.path.join(self.local_icommands_build_dir, '*.{0}'.format(get_package_suffix()))),
+                                     glob.glob(os.path.join(self.local_icommands_build_dir, '*.output'))):
                 shutil.copy2(f, self.output_directory)
 
+    # icommands only need the irods-dev and irods-runtime packages, so cpack produces those two components
+    # on their own first and the icommands build runs while the full server packaging runs beside it
     def build_irods_packages_cmake(self):
+        icommands_clone = BackgroundTask(git_clone, self.git_repository_icommands, self.git_commitish_icommands, self.local_icommands_git_dir)
         self.install_cmake_externals()
+        self.configure_ccache()
         os.mkdir(self.local_irods_build_dir)
-        self.module.run_command('cmake {0} > cmake_irods.output'.format(self.local_irods_git_dir), cwd=self.local_irods_build_dir, use_unsafe_shell=True, check_rc=True)
-        self.module.run_command('make -j4 > {0}'.format('make_irods.output'), cwd=self.local_irods_build_dir, use_unsafe_shell=True, check_rc=True)
-        self.module.run_command('fakeroot make package >> {0}'.format('make_irods.output'), cwd=self.local_irods_build_dir, use_unsafe_shell=True, check_rc=True)
-        self.build_icommands_cmake()
-
-    def build_icommands_cmake(self):
-        install_os_packages_from_files(itertools.chain(glob.glob(os.path.join(self.local_irods_build_dir, 'irods-dev*.{0}'.format(get_package_suffix()))),
-                                                       glob.glob(os.path.join(self.local_irods_build_dir, 'irods-runtime*.{0}'.format(get_package_suffix())))))
-        icommands_git_dir = '/home/irodsbuild/irods_client_icommands'
-        git_clone(self.git_repository_icommands, self.git_commitish_icommands, icommands_git_dir)
-        icommands_build_dir = '/home/irodsbuild/icommands_build'
-        os.mkdir(icommands_build_dir)
-        self.module.run_command('cmake {0} > cmake_icommands.output'.format(icommands_git_dir), cwd=icommands_build_dir, use_unsafe_shell=True, check_rc=True)
-        self.module.run_command('make -j4 > {0}'.format('make_icommands.output'), cwd=icommands_build_dir, use_unsafe_shell=True, check_rc=True)
-        self.module.run_command('fakeroot make package >> {0}'.format('make_icommands.output'), cwd=icommands_build_dir, use_unsafe_shell=True, check_rc=True)
-        for f in itertools.chain(glob.glob(os.path.join(icommands_build_dir, '*.{0}'.format(get_package_suffix()))),
-                                 glob.glob(os.path.join(icommands_build_dir, '*.output'))):
-            shutil.copy2(f, self.output_directory)
+        self.module.run_command('cmake {0} {1} > cmake_irods.output'.format(self.cmake_compiler_launcher_arguments, self.local_irods_git_dir), cwd=self.local_irods_build_dir, use_unsafe_shell=True, check_rc=True)
+        self.module.run_command('make -j{0} > {1}'.format(self.build_jobs, 'make_irods.output'), cwd=self.local_irods_build_dir, use_unsafe_shell=True, check_rc=True)
+        self.write_ccache_statistics(os.path.join(self.local_irods_build_dir, 'ccache_irods.output'))
+        icommands_dependencies = self.package_icommands_dependencies()
+        self.wait_for_background_task(icommands_clone, 'cloning the icommands')
+
+        icommands_build = None
+        if icommands_dependencies:
+            icommands_build = BackgroundTask(self.build_icommands_cmake, icommands_dependencies)
+        rc, _, _ = self.module.run_command('fakeroot make package >> {0} 2>&1'.format('make_irods.output'), cwd=self.local_irods_build_dir, use_unsafe_shell=True)
+        if rc != 0:
+            if icommands_build is not None:
+                icommands_build.join()
+            self.module.fail_json(msg='fakeroot make package failed for iRODS, see make_irods.output', rc=rc)
+        if icommands_build is None:
+            icommands_build = BackgroundTask(self.build_icommands_cmake, self.find_icommands_dependencies(self.local_irods_build_dir))
+        self.wait_for_background_task(icommands_build, 'building the icommands')
+
+    def find_icommands_dependencies(self, directory):
+        return list(itertools.chain.from_iterable(glob.glob(os.path.join(directory, 'irods-{0}*.{1}'.format(name, get_package_suffix()))) for name in ['dev', 'runtime']))
+
+    # CPackConfig.cmake sets CPACK_COMPONENTS_ALL itself, so the component list is narrowed in a config
+    # that includes it. The packages are moved out of the build directory, where the full packaging rewrites
+    # them while the icommands build installs them; an empty list (e.g. components named differently) means
+    # waiting for the full packaging instead.
+    def package_icommands_dependencies(self):
+        config_file = os.path.join(self.local_irods_build_dir, 'CPackConfigIcommandsDependencies.cmake')
+        with open(config_file, 'w') as f:
+            f.write('include("{0}")\nset(CPACK_COMPONENTS_ALL irods-dev irods-runtime)\n'.format(os.path.join(self.local_irods_build_dir, 'CPackConfig.cmake')))
+        self.module.run_command('fakeroot cpack --config {0} >> {1} 2>&1'.format(config_file, 'make_irods.output'), cwd=self.local_irods_build_dir, use_unsafe_shell=True)
+        packages = self.find_icommands_dependencies(self.local_irods_build_dir)
+        if len(packages) != 2:
+            return []
+        dependencies_directory = tempfile.mkdtemp(prefix='icommands_dependencies')
+        for package in packages:
+            shutil.move(package, dependencies_directory)
+        return self.find_icommands_dependencies(dependencies_directory)
+
+    # background tasks raise their failures, this reports them the way module.run_command's check_rc would
+    def wait_for_background_task(self, task, description):
+        try:
+            task.wait()
+        except Exception as e:
+            self.module.fail_json(msg='{0} failed: {1}'.format(description, e))
+
+    # runs on a background thread, so failures are raised rather than reported through module.run_command
+    def build_icommands_cmake(self, icommands_dependencies):
+        install_os_packages_from_files(icommands_dependencies)
+        os.mkdir(self.local_icommands_build_dir)
+        subprocess_get_output('cmake {0} {1} > cmake_icommands.output'.format(self.cmake_compiler_launcher_arguments, self.local_icommands_git_dir), cwd=self.local_icommands_build_dir, shell=True, check_rc=True)
+        subprocess_get_output('make -j{0} > {1}'.format(self.build_jobs, 'make_icommands.output'), cwd=self.local_icommands_build_dir, shell=True, check_rc=True)
+        self.write_ccache_statistics(os.path.join(self.local_icommands_build_dir, 'ccache_icommands.output'))
+        subprocess_get_output('fakeroot make package >> {0}'.format('make_icommands.output'), cwd=self.local_icommands_build_dir, shell=True, check_rc=True)
+
+    def configure_ccache(self):
+        ccache_directory = get_artifact_cache_directory(self.artifact_cache_root_directory, 'ccache', get_irods_platform_string())
+        if ccache_directory is None:
+            return
+        try:
+            install_os_packages(['ccache'])
+        except Exception:
+            pass # not packaged everywhere (e.g. CentOS without EPEL), build without it
+        if self.module.get_bin_path('ccache') is None:
+            return
+        if not os.path.exists(ccache_directory):
+            os.makedirs(ccache_directory)
+        os.environ['CCACHE_DIR'] = ccache_directory
+        os.environ['CCACHE_BASEDIR'] = os.path.expanduser('~')
+        self.module.run_command(['ccache', '-z'], check_rc=True)
+        self.use_ccache = True
+
+    @property
+    def cmake_compiler_launcher_arguments(self):
+        if not self.use_ccache:
+            return ''
+        return '-DCMAKE_C_COMPILER_LAUNCHER=ccache -DCMAKE_CXX_COMPILER_LAUNCHER=ccache'
+
+    def write_ccache_statistics(self, output_file):
+        if self.use_ccache:
+            subprocess_get_output('ccache -s > {0}'.format(output_file), shell=True, check_rc=True)
+            subprocess_get_output(['ccache', '-z'], check_rc=True)
 
     def install_cmake_externals(self):
-        install_irods_repository()
+        install_irods_repository(get_local_package_repository_directory(self.artifact_cache_root_directory))
         with open(os.path.join(self.local_irods_git_dir, 'externals.json')) as f:
             d = json.load(f)
         install_os_packages([d['cmake']] + d['others'])
@@ -118,12 +223,56 @@ class GenericStrategy(object):
         finally:
             shutil.copytree(os.path.join(self.local_irods_git_dir, 'build'), self.output_directory)
 
+    @property
+    def buildsh_variants(self):
+        return [('icat postgres', 'icat_postgres'), ('resource postgres', 'resource'), ('icat mysql', 'icat_mysql')]
+
+    # packages build.sh's preflight would otherwise install for a variant itself, keyed by log suffix
+    @property
+    def buildsh_variant_dependencies(self):
+        return {}
+
+    # the first variant builds the shared core in place; every other variant then starts from a copy of
+    # that tree, so they only rebuild what differs and can all run at the same time
     def build_irods_packages_buildsh(self):
         os.makedirs(os.path.join(self.local_irods_git_dir, 'build'))
+        first_variant, other_variants = self.buildsh_variants[0], self.buildsh_variants[1:]
+        self.run_buildsh(self.local_irods_git_dir, first_variant)
+
+        # build.sh installs whatever it finds missing before it builds; with every variant's packages
+        # installed here, one at a time, the concurrent runs never contend for the package manager's lock
+        variant_dependencies = []
+        for _, log_suffix in other_variants:
+            variant_dependencies.extend(self.buildsh_variant_dependencies.get(log_suffix, []))
+        if variant_dependencies:
+            install_os_packages(variant_dependencies)
+
+        worktrees = []
+        for _, log_suffix in other_variants:
+            worktree = '{0}_{1}'.format(self.local_irods_git_dir, log_suffix)
+            subprocess_get_output(['sudo', 'cp', '-a', self.local_irods_git_dir, worktree], check_rc=True)
+            worktrees.append(worktree)
+        builds = [BackgroundTask(self.run_buildsh, variant_worktree, variant) for variant_worktree, variant in zip(worktrees, other_variants)]
+        for build in builds:
+            build.join()
+
+        build_dir = os.path.join(self.local_irods_git_dir, 'build')
+        for worktree in worktrees:
+            for basename in os.listdir(os.path.join(worktree, 'build')):
+                if not os.path.exists(os.path.join(build_dir, basename)):
+                    shutil.copy2(os.path.join(worktree, 'build', basename), build_dir)
+        for build, (_, log_suffix) in zip(builds, other_variants):
+            self.wait_for_background_task(build, 'build.sh for {0}, see build_output_{0}.log'.format(log_suffix))
+
+    # variants build concurrently, each gets its own TMPDIR so their scratch files can't clobber each other
+    def run_buildsh(self, git_dir, variant):
         build_flags = '' if self.debug_build else '-r'
-        self.module.run_command('sudo ./packaging/build.sh {0} icat postgres > ./build/build_output_icat_postgres.log 2>&1'.format(build_flags), cwd=self.local_irods_git_dir, use_unsafe_shell=True, check_rc=True)
-        self.module.run_command('sudo ./packaging/build.sh {0} resource postgres > ./build/build_output_resource.log 2>&1'.format(build_flags), cwd=self.local_irods_git_dir, use_unsafe_shell=True, check_rc=True)
-        self.module.run_command('sudo ./packaging/build.sh {0} icat mysql > ./build/build_output_icat_mysql.log 2>&1'.format(build_flags), cwd=self.local_irods_git_dir, use_unsafe_shell=True, check_rc=True)
+        build_arguments, log_suffix = variant
+        temp_dir = tempfile.mkdtemp(prefix='buildsh_{0}_'.format(log_suffix))
+        try:
+            subprocess_get_output('sudo env TMPDIR={0} ./packaging/build.sh {1} {2} > ./build/build_output_{3}.log 2>&1'.format(temp_dir, build_flags, build_arguments, log_suffix), cwd=git_dir, shell=True, check_rc=True)
+        finally:
+            subprocess_get_output(['sudo', 'rm', '-rf', temp_dir], check_rc=True)
 
 class RedHatStrategy(GenericStrategy):
     @property
@@ -141,18 +290,19 @@ class RedHatStrategy(GenericStrategy):
             self.install_oracle_dependencies()
 
     def install_oracle_dependencies(self):
-        tar_file = os.path.expanduser('~/oci.tar')
-        self.module.run_command(['wget', 'http://people.renci.org/~jasonc/irods/oci.tar', '-O', tar_file], check_rc=True)
-        tar_dir = os.path.expanduser('~/oci')
-        os.mkdir(tar_dir)
-        self.module.run_command(['tar', '-xf', 'oci.tar', '-C', tar_dir], check_rc=True)
-        self.module.run_command('sudo rpm -i --nodeps ./oci/*', use_unsafe_shell=True, check_rc=True)
+        oci_dir = fetch_oracle_instant_client_packages()
+        self.module.run_command('sudo rpm -i --nodeps {0}/*'.format(oci_dir), use_unsafe_shell=True, check_rc=True)
 
-    def build_irods_packages_buildsh(self):
-        super(RedHatStrategy, self).build_irods_packages_buildsh()
+    @property
+    def buildsh_variants(self):
+        variants = super(RedHatStrategy, self).buildsh_variants
         if get_distribution_version_major() == '6':
-            build_flags = '' if self.debug_build else '-r'
-            self.module.run_command('sudo ./packaging/build.sh {0} icat oracle > ./build/build_output_icat_oracle.log 2>&1'.format(build_flags), cwd=self.local_irods_git_dir, use_unsafe_shell=True, check_rc=True)
+            variants.append(('icat oracle', 'icat_oracle'))
+        return variants
+
+    @property
+    def buildsh_variant_dependencies(self):
+        return {'icat_mysql': ['mysql-devel']}
 
 class DebianStrategy(GenericStrategy):
     @property
@@ -168,18 +318,17 @@ class DebianStrategy(GenericStrategy):
         self.install_oracle_dependencies()
 
     def install_oracle_dependencies(self):
-        tar_file = os.path.expanduser('~/oci.tar')
-        self.module.run_command(['wget', 'http://people.renci.org/~jasonc/irods/oci.tar', '-O', tar_file], check_rc=True)
-        tar_dir = os.path.expanduser('~/oci')
-        os.mkdir(tar_dir)
-        self.module.run_command(['tar', '-xf', 'oci.tar', '-C', tar_dir], check_rc=True)
+        oci_dir = fetch_oracle_instant_client_packages()
         install_os_packages(['alien', 'libaio1'])
-        self.module.run_command('sudo alien -i ./oci/*', use_unsafe_shell=True, check_rc=True)
+        self.module.run_command('sudo alien -i {0}/*'.format(oci_dir), use_unsafe_shell=True, check_rc=True)
 
-    def build_irods_packages_buildsh(self):
-        super(DebianStrategy, self).build_irods_packages_buildsh()
-        build_flags = '' if self.debug_build else '-r'
-        self.module.run_command('sudo ./packaging/build.sh {0} icat oracle > ./build/build_output_icat_oracle.log 2>&1'.format(build_flags), cwd=self.local_irods_git_dir, use_unsafe_shell=True, check_rc=True)
+    @property
+    def buildsh_variants(self):
+        return super(DebianStrategy, self).buildsh_variants + [('icat oracle', 'icat_oracle')]
+
+    @property
+    def buildsh_variant_dependencies(self):
+        return {'icat_mysql': ['libmysqlclient-dev']}
 
 class SuseStrategy(GenericStrategy):
     @property
@@ -191,6 +340,10 @@ class SuseStrategy(GenericStrategy):
         self.module.run_command(['sudo', 'zypper', '--gpg-auto-import-keys', 'refresh'], check_rc=True)
         super(SuseStrategy, self).install_building_dependencies()
 
+    @property
+    def buildsh_variant_dependencies(self):
+        return {'icat_mysql': ['libmysqlclient-devel']}
+
 class CentOS6Builder(Builder):
     platform = 'Linux'
     distribution = 'Centos'
@@ -220,6 +373,8 @@ def main():
             debug_build=dict(type='bool', required=True),
             git_repository_icommands=dict(type='str', required=True),
             git_commitish_icommands=dict(type='str', required=True),
+            build_jobs=dict(type='int', required=False),
+            artifact_cache_root_directory=dict(type='str', required=False),
         ),
         supports_check_mode=False,
     )
@@ -12,7 +12,7 @@ import irods_python_ci_utilities
 
 
 def checkout_git_repo_and_run_build_hook(git_repository, git_commitish, python_script, passthrough_arguments):
-    git_checkout_dir = irods_python_ci_utilities.git_clone(git_repository, git_commitish)
+    git_checkout_dir = git_clone(git_repository, git_commitish)
     return irods_python_ci_utilities.subprocess_get_output(['python', python_script] + passthrough_arguments, cwd=git_checkout_dir, check_rc=True)
 
 def main():
@@ -1,12 +1,17 @@
 #!/usr/bin/python
 
+import Queue
 import abc
 import glob
+import hashlib
 import itertools
 import json
 import os
+import re
 import shutil
 import tempfile
+import threading
+import time
 
 
 class UnimplementedStrategy(object):
@@ -46,6 +51,10 @@ class GenericStrategy(object):
         self.output_root_directory = module.params['output_root_directory']
         self.git_repository = module.params['git_repository']
         self.git_commitish = module.params['git_commitish']
+        self.artifact_cache_root_directory = module.params['artifact_cache_root_directory']
+        self.external_source_sha256s = module.params['external_source_sha256s'] or {}
+        self.external_source_commits = {}
+        self.git_source_mirrors = []
         self.local_git_dir = tempfile.mkdtemp(prefix='irods_externals', dir='/tmp') #os.path.expanduser('~/irods_externals')
 
     @property
@@ -56,13 +65,18 @@ class GenericStrategy(object):
         self.prepare_git_repository()
         self.install_dependencies()
         self.setup_build_environment()
-        self.build_externals_and_copy_output()
+        self.prefetch_external_sources()
+        try:
+            report = self.build_externals_and_copy_output()
+        finally:
+            self.stop_using_git_source_mirrors()
+            self.cache_external_sources()
+        self.publish_externals_packages()
+        return report
 
     def prepare_git_repository(self):
         install_os_packages(['git'])
-        self.module.run_command(['git', 'clone', '--recursive', self.git_repository, self.local_git_dir], check_rc=True)
-        self.module.run_command(['git', 'checkout', self.git_commitish], cwd=self.local_git_dir, check_rc=True)
-        self.module.run_command(['git', 'submodule', 'update', '--init', '--recursive'], cwd=self.local_git_dir, check_rc=True)
+        git_clone(self.git_repository, self.git_commitish, self.local_git_dir)
 
     def install_dependencies(self):
         self.module.run_command([os.path.join(self.local_git_dir, 'install_prerequisites.py')], check_rc=True)
@@ -70,9 +84,65 @@ class GenericStrategy(object):
     def setup_build_environment(self):
         pass
 
+    # an external's sources are its git_repository at commitish, pinned by the commit that resolves to, and
+    # any archive urls in its entry, pinned only by external_source_sha256s; nothing unpinned is cached
+    def get_external_git_sources(self):
+        git_sources = []
+        for entry in self.load_externals_versions().values():
+            commit = self.get_external_source_commit(entry)
+            if 'git_repository' in entry and commit:
+                git_sources.append((entry['git_repository'], commit))
+        return sorted(set(git_sources))
+
+    def get_external_source_urls(self):
+        urls = re.findall(r'https?://[^\s"\'{}]+?\.(?:tar\.gz|tgz|tar\.bz2|tar\.xz|zip)\b', json.dumps(self.load_externals_versions().values()))
+        return sorted(set(urls))
+
+    def get_external_source_cache_directory(self, url):
+        if url not in self.external_source_sha256s:
+            return None
+        return get_artifact_cache_directory(self.artifact_cache_root_directory, 'externals_sources', self.external_source_sha256s[url])
+
+    # git sources are cloned from the controller's mirrors, which git itself checks against the pinned commits
+    def prefetch_external_sources(self):
+        git_mirror_root_directory = os.environ.get('IRODS_GIT_MIRROR_ROOT_DIRECTORY')
+        if git_mirror_root_directory and os.path.isdir(git_mirror_root_directory):
+            for repository, commit in self.get_external_git_sources():
+                try:
+                    git_mirror = update_git_mirror(git_mirror_root_directory, repository)
+                except Exception:
+                    continue # the build clones from the network
+                rc, _, _ = subprocess_get_output(['git', '--git-dir', git_mirror, 'cat-file', '-e', commit + '^{commit}'])
+                if rc != 0:
+                    continue
+                subprocess_get_output(['git', 'config', '--global', '--add', 'url.{0}.insteadOf'.format(git_mirror), repository], check_rc=True)
+                self.git_source_mirrors.append(git_mirror)
+
+        for url in self.get_external_source_urls():
+            cache_directory = self.get_external_source_cache_directory(url)
+            if cache_directory is None:
+                continue
+            archive = os.path.join(cache_directory, os.path.basename(url))
+            if os.path.isfile(archive) and sha256_of_file(archive) == self.external_source_sha256s[url]:
+                shutil.copy2(archive, self.local_git_dir)
+
+    def stop_using_git_source_mirrors(self):
+        for git_mirror in self.git_source_mirrors:
+            subprocess_get_output(['git', 'config', '--global', '--unset-all', 'url.{0}.insteadOf'.format(git_mirror)])
+        self.git_source_mirrors = []
+
+    def cache_external_sources(self):
+        for url in self.get_external_source_urls():
+            cache_directory = self.get_external_source_cache_directory(url)
+            archive = os.path.join(self.local_git_dir, os.path.basename(url))
+            if cache_directory is None or os.path.isdir(cache_directory) or not os.path.isfile(archive):
+                continue
+            if sha256_of_file(archive) == self.external_source_sha256s[url]:
+                publish_to_artifact_cache([archive], cache_directory)
+
     def build_externals_and_copy_output(self):
         try:
-            self.build_externals()
+            return self.build_externals()
         finally:
             if not os.path.exists(self.output_directory):
                 try:
@@ -86,7 +156,222 @@ class GenericStrategy(object):
                         raise
 
     def build_externals(self):
-        self.module.run_command(['make'], cwd=self.local_git_dir, check_rc=True)
+        externals = self.load_externals_versions()
+        dependencies = self.get_externals_dependencies(externals)
+        if dependencies is None:
+            self.module.run_command(['make'], cwd=self.local_git_dir, check_rc=True)
+            return None
+
+        hashes = self.get_externals_hashes(externals, dependencies)
+        stale = set()
+        for name in externals:
+            if not self.restore_external_from_cache(name, externals[name], hashes[name]):
+                stale.add(name)
+        # the stale externals' dependencies that were restored from the cache are installed from their packages
+        # for the stale builds to use, make is told they are up to date (see build_externals_in_dependency_order)
+        to_build = set(stale)
+        cached_dependencies = set()
+        for name in stale:
+            cached_dependencies.update(self.get_transitive_dependencies(name, dependencies) - stale)
+        self.install_cached_externals(cached_dependencies, externals)
+
+        report = {}
+        for name in externals:
+            report[name] = {'hash': hashes[name], 'cached': name not in to_build}
+        failures = self.build_externals_in_dependency_order(to_build, dependencies, report)
+        if failures:
+            self.module.fail_json(msg='building externals failed', failures=failures, externals=report)
+        for name in to_build:
+            self.publish_external_to_cache(name, externals[name], hashes[name])
+        return report
+
+    def publish_externals_packages(self):
+        local_repository_directory = get_local_package_repository_directory(self.artifact_cache_root_directory)
+        if local_repository_directory is None:
+            return
+        packages = glob.glob(os.path.join(self.local_git_dir, '*.{0}'.format(get_package_suffix())))
+        if packages:
+            publish_to_local_package_repository(packages, local_repository_directory)
+
+    def load_externals_versions(self):
+        with open(os.path.join(self.local_git_dir, 'versions.json')) as f:
+            versions = json.load(f)
+        externals = {}
+        for name, entry in versions.items():
+            if isinstance(entry, dict):
+                externals[name] = entry
+        return externals
+
+    def get_externals_dependencies(self, externals):
+        # the Makefile is the source of truth for build order, read from make's database
+        _, out, _ = subprocess_get_output(['make', '-p', '-q'], cwd=self.local_git_dir)
+        rules = {}
+        for line in out.splitlines():
+            if not line or line[0] in '#\t.' or ':' not in line:
+                continue
+            target, _, prerequisites = line.partition(':')
+            if '=' in target or prerequisites.startswith('='):
+                continue
+            rules.setdefault(target.strip(), []).extend(prerequisites.split('|')[0].split())
+        if not [name for name in externals if name in rules]:
+            return None
+
+        def external_prerequisites(target, visited):
+            found = set()
+            for prerequisite in rules.get(target, []):
+                if prerequisite in visited:
+                    continue
+                visited.add(prerequisite)
+                if prerequisite in externals:
+                    found.add(prerequisite)
+                else:
+                    found.update(external_prerequisites(prerequisite, visited))
+            return found
+
+        dependencies = {}
+        for name in externals:
+            dependencies[name] = external_prerequisites(name, set([name]))
+        return dependencies
+
+    def get_transitive_dependencies(self, name, dependencies):
+        found = set()
+        for dependency in dependencies[name]:
+            found.add(dependency)
+            found.update(self.get_transitive_dependencies(dependency, dependencies))
+        return found
+
+    # the recipe is every file tracked by the externals repository except versions.json, whose entries are
+    # hashed one external at a time; an external whose source cannot be pinned gets no hash and is never cached
+    def get_externals_hashes(self, externals, dependencies):
+        _, out, _ = subprocess_get_output(['git', 'ls-tree', '-r', 'HEAD'], cwd=self.local_git_dir, check_rc=True)
+        recipe = hashlib.sha256()
+        for line in out.splitlines():
+            if line.split('\t', 1)[1] != 'versions.json':
+                recipe.update(line)
+        recipe.update(get_irods_platform_string())
+
+        hashes = {}
+        def compute_hash(name):
+            if name not in hashes:
+                source = self.get_external_source_commit(externals[name])
+                dependency_hashes = [compute_hash(dependency) for dependency in sorted(dependencies[name])]
+                if source is None or None in dependency_hashes:
+                    hashes[name] = None
+                else:
+                    h = recipe.copy()
+                    h.update(json.dumps(externals[name], sort_keys=True))
+                    h.update(source)
+                    for dependency_hash in dependency_hashes:
+                        h.update(dependency_hash)
+                    hashes[name] = h.hexdigest()
+            return hashes[name]
+
+        for name in externals:
+            compute_hash(name)
+        return hashes
+
+    # the commit an external's commitish names, '' for externals built from the recipe alone, None when
+    # the commitish cannot be resolved (e.g. an abbreviated commit) and the external's source is unknown
+    def get_external_source_commit(self, entry):
+        if 'commitish' not in entry:
+            return ''
+        commitish = entry['commitish']
+        if re.match(r'^[0-9a-f]{40}$', commitish):
+            return commitish
+        if 'git_repository' not in entry:
+            return None
+        key = (entry['git_repository'], commitish)
+        if key not in self.external_source_commits:
+            self.external_source_commits[key] = None
+            rc, out, _ = subprocess_get_output(['git', 'ls-remote', entry['git_repository'], commitish, commitish + '^{}'])
+            refs = dict(reversed(line.split('\t')) for line in out.splitlines()) if rc == 0 else {}
+            for ref in ['refs/tags/{0}^{{}}', 'refs/tags/{0}', 'refs/heads/{0}']:
+                if ref.format(commitish) in refs:
+                    self.external_source_commits[key] = refs[ref.format(commitish)]
+                    break
+        return self.external_source_commits[key]
+
+    def get_external_cache_directory(self, name, entry, external_hash):
+        if 'version_string' not in entry:
+            return None # packages cannot be told apart from other externals'
+        if external_hash is None:
+            return None
+        return get_artifact_cache_directory(self.artifact_cache_root_directory, 'irods_externals', get_irods_platform_string(), name, external_hash)
+
+    def get_external_packages(self, name, entry):
+        return glob.glob(os.path.join(self.local_git_dir, 'irods-externals-{0}{1}-*.{2}'.format(name, entry['version_string'], get_package_suffix())))
+
+    def restore_external_from_cache(self, name, entry, external_hash):
+        cache_directory = self.get_external_cache_directory(name, entry, external_hash)
+        if cache_directory is None or not os.path.isdir(cache_directory):
+            return False
+        for f in os.listdir(cache_directory):
+            shutil.copy2(os.path.join(cache_directory, f), self.local_git_dir)
+        return True
+
+    def install_cached_externals(self, names, externals):
+        packages = []
+        for name in sorted(names):
+            packages.extend(self.get_external_packages(name, externals[name]))
+        if packages:
+            install_os_packages_from_files(packages)
+
+    def publish_external_to_cache(self, name, entry, external_hash):
+        cache_directory = self.get_external_cache_directory(name, entry, external_hash)
+        if cache_directory is None:
+            return
+        packages = self.get_external_packages(name, entry)
+        if packages:
+            publish_to_artifact_cache(packages, cache_directory)
+
+    def build_externals_in_dependency_order(self, to_build, dependencies, report):
+        finished = Queue.Queue()
+        def build_external(name, jobs):
+            start = time.time()
+            try:
+                # dependencies, built earlier in this run or installed from the cache, are marked old so make does not redo them
+                args = ['make', '-j{0}'.format(jobs)]
+                for dependency in sorted(self.get_transitive_dependencies(name, dependencies)):
+                    args.extend(['-o', dependency])
+                args.append(name)
+                rc, out, err = subprocess_get_output(args, cwd=self.local_git_dir)
+                with open(os.path.join(self.local_git_dir, '{0}.make.log'.format(name)), 'w') as f:
+                    f.write(out)
+                    f.write(err)
+                result = None if rc == 0 else 'make {0} returned {1}, see {0}.make.log'.format(name, rc)
+            except Exception as e:
+                result = str(e)
+            finished.put((name, result, time.time() - start))
+
+        # the machine's job budget is shared out between the builds running at the same time
+        job_budget = get_build_parallelism()
+        pending = set(to_build)
+        running = {}
+        built = set()
+        failures = {}
+        while pending or running:
+            if not failures:
+                ready = [name for name in sorted(pending) if not ((dependencies[name] & to_build) - built)]
+                if not ready and not running:
+                    failures.update(dict((name, 'unbuildable, dependency cycle') for name in pending))
+                    break
+                starting = ready[:job_budget - sum(running.values())]
+                for i, name in enumerate(starting):
+                    jobs = max(1, (job_budget - sum(running.values())) // (len(starting) - i))
+                    pending.remove(name)
+                    running[name] = jobs
+                    report[name]['jobs'] = jobs
+                    threading.Thread(target=build_external, args=(name, jobs)).start()
+            elif not running:
+                break
+            name, failure, seconds = finished.get()
+            del running[name]
+            report[name]['seconds'] = seconds
+            if failure is None:
+                built.add(name)
+            else:
+                failures[name] = failure
+        return failures
 
 class RedHatStrategy(GenericStrategy):
     def setup_build_environment(self):
@@ -129,17 +414,20 @@ def main():
             output_root_directory=dict(type='str', required=True),
             git_repository=dict(type='str', required=True),
             git_commitish=dict(type='str', required=True),
+            artifact_cache_root_directory=dict(type='str', required=False),
+            external_source_sha256s=dict(type='dict', required=False),
         ),
         supports_check_mode=False,
     )
 
     builder = Builder(module)
-    builder.build()
+    externals_report = builder.build()
 
     result = {}
     result['changed'] = True
     result['complex_args'] = module.params
     result['irods_platform_string'] = get_irods_platform_string()
+    result['externals'] = externals_report
     module.exit_json(**result)
 
 
@@ -1,25 +1,19 @@
 #!/usr/bin/python
 
+import contextlib
+import hashlib
+import json
 import os
 import socket
 import subprocess
+import tarfile
 
 
-def makedirs_catch_preexisting(*args, **kwargs):
-    try:
-        os.makedirs(*args, **kwargs)
-    except OSError as e:
-        if e[0] != 17: # 17 == File exists
-            raise
-
+# The collected files are read through sudo and streamed as one gzipped tar straight into
+# output_root_directory/<hostname>.tar.gz, so nothing on the server has its permissions changed.
+# output_root_directory/<hostname>.manifest.json lists each archived file's path, size, mtime and
+# sha256, read back from the archive so it describes exactly what was stored.
 def gather(output_root_directory):
-    change_permissions_if_exists('/var/lib/irods')
-    change_permissions_if_exists('/tmp/irods')
-
-    output_directory = os.path.join(output_root_directory, socket.gethostname())
-    makedirs_catch_preexisting(output_directory)
-
-    gathered_files = []
     source_and_predicates = [('/var/lib/irods/iRODS/server/log', all_files),
                              ('/tmp/irods', all_files),
                              ('/var/lib/irods/tests/pydevtest/test-reports', all_files),
@@ -28,9 +22,22 @@ def gather(output_root_directory):
                              ('/var/lib/irods', or_(version_files, ini_files)),
                              ('/var/lib/irods/iRODS/installLogs', all_files),
                              ('/var/lib/irods/log', all_files),]
+    paths = []
     for s, p in source_and_predicates:
-        gathered_files += gather_files_in(s, output_directory, p)
-    return gathered_files
+        paths += list_files_in(s, p)
+
+    makedirs_catch_preexisting(output_root_directory)
+    hostname = socket.gethostname()
+    archive = os.path.join(output_root_directory, hostname + '.tar.gz')
+    write_archive(paths, archive)
+    gathered_files = list_archived_files(archive)
+    manifest = {
+        'hostname': hostname,
+        'archive': os.path.basename(archive),
+        'files': gathered_files,
+    }
+    write_file_atomically(os.path.join(output_root_directory, hostname + '.manifest.json'), json.dumps(manifest, indent=4, sort_keys=True))
+    return [f['path'] for f in gathered_files]
 
 def or_(f0, f1):
     return lambda x: f0(x) or f1(x)
@@ -47,23 +54,36 @@ def version_files(x):
 def ini_files(x):
     return x.endswith('.ini')
 
-def gather_files_in(source_directory, output_directory, predicate):
-    try:
-        gathered_files = []
-        for basename in os.listdir(source_directory):
-            fullpath = os.path.join(source_directory, basename)
-            if os.path.isfile(fullpath):
-                if predicate(fullpath):
-                    shutil.copy2(fullpath, output_directory)
-                    gathered_files.append(fullpath)
-    except OSError as e:
-        if e.errno != 2: # No such file or directory
-            raise
-    return gathered_files
-
-def change_permissions_if_exists(directory):
-    if os.path.exists(directory):
-        subprocess.check_call(['sudo', 'chmod', '-R', '777', directory])
+def list_files_in(source_directory, predicate):
+    returncode, out, err = subprocess_get_output(['sudo', 'find', source_directory, '-maxdepth', '1', '-type', 'f', '-print0'])
+    if returncode != 0:
+        if 'No such file or directory' in err:
+            return []
+        raise RuntimeError('listing [{0}] failed: {1}'.format(source_directory, err))
+    return [path for path in sorted(out.split('\0')) if path and predicate(path)]
+
+def write_archive(paths, archive):
+    temp_archive = archive + '.partial'
+    with open(temp_archive, 'wb') as f:
+        p = subprocess.Popen(['sudo', 'tar', '-C', '/', '--ignore-failed-read', '--null', '-T', '-', '-czf', '-'], stdin=subprocess.PIPE, stdout=f, stderr=subprocess.PIPE)
+        _, err = p.communicate(''.join(path.lstrip('/') + '\0' for path in paths))
+    if p.returncode not in [0, 1]: # 1 is a log that grew while it was read, the archive holds what was read
+        os.unlink(temp_archive)
+        raise RuntimeError('archiving gathered files into [{0}] failed: {1}'.format(archive, err))
+    os.rename(temp_archive, archive)
+
+def list_archived_files(archive):
+    files = []
+    with contextlib.closing(tarfile.open(archive, 'r:gz')) as t:
+        for member in t:
+            if not member.isfile():
+                continue
+            h = hashlib.sha256()
+            f = t.extractfile(member)
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                h.update(chunk)
+            files.append({'path': '/' + member.name, 'size': member.size, 'mtime': member.mtime, 'sha256': h.hexdigest()})
+    return files
 
 def main():
     module = AnsibleModule(
@@ -84,4 +104,5 @@ def main():
 
 
 from ansible.module_utils.basic import *
+from ansible.module_utils.local_ansible_utils_extension import *
 main()
@@ -45,11 +45,14 @@ class GenericStrategy(object):
     def __init__(self, module):
         self.module = module
         self.module.debug_messages = {}
+        self.module.setup_irods_configuration = None
+        self.module.setup_irods_configuration_inputs_sha256 = None
         self.irods_packages_root_directory = module.params['irods_packages_root_directory']
         self.mungefs_packages_root_directory = module.params['mungefs_packages_root_directory']
         self.icat_server = module.params['icat_server']
         self.icat_database_type = module.params['icat_server']['database_config']['catalog_database_type']
         self.install_dev_package = module.params['install_dev_package']
+        self.artifact_cache_root_directory = module.params['artifact_cache_root_directory']
 
     @abc.abstractmethod
     def install_database(self):
@@ -84,7 +87,7 @@ class GenericStrategy(object):
 
     def install_pip(self):
         local_pip_git_dir = os.path.expanduser('~/pip')
-        git_clone('https://github.com/pypa/pip.git', '10.0.1', local_pip_git_dir)
+        git_clone('https://github.com/pypa/pip.git', '10.0.1', local_pip_git_dir, shallow=True)
         self.module.run_command(['sudo', '-E', 'python', 'setup.py', 'install'], cwd=local_pip_git_dir, check_rc=True)
 
     @property
@@ -141,6 +144,9 @@ class GenericStrategy(object):
             assert False, self.icat_database_type
 
     def run_setup_script(self):
+        if irods_setup_script_supports_json_configuration():
+            return self.run_setup_script_unattended()
+
         def get_setup_input_template():
             if os.path.exists('/var/lib/irods/scripts/setup_irods.py'):
                 preamble = '''\
@@ -296,6 +302,35 @@ yes
         self.module.debug_messages['setup_irods input'] = setup_input.split('\n')
         self.module.run_command(['sudo', 'su', '-c', '{0} 2>&1 | tee {1}; exit $PIPESTATUS'.format(get_setup_script_location(), output_log)], use_unsafe_shell=True, check_rc=True, data=setup_input)
 
+    def run_setup_script_unattended(self):
+        setup_configuration, inputs_sha256 = get_irods_setup_configuration(self.icat_server.get('deployment_information', {}), self.icat_server['server_config'], 'provider', self.icat_server['hostname'], 'demoResc', 'rods', self.get_database_configuration())
+        self.module.setup_irods_configuration = setup_configuration
+        self.module.setup_irods_configuration_inputs_sha256 = inputs_sha256
+        run_irods_setup_script_with_json_configuration(setup_configuration, '/var/lib/irods/log/setup_irods.output')
+
+    def get_database_configuration(self):
+        database_config = self.icat_server['database_config']
+        return {
+            self.icat_database_type: {
+                'db_host': database_config['db_host'],
+                'db_name': database_config['db_name'],
+                'db_odbc_driver': database_config.get('db_odbc_driver', self.get_odbc_driver()),
+                'db_password': database_config['db_password'],
+                'db_port': database_config['db_port'],
+                'db_username': database_config['db_username'],
+            }
+        }
+
+    def get_odbc_driver(self):
+        _, out, _ = self.module.run_command(['odbcinst', '-q', '-d'], check_rc=True)
+        drivers = [line.strip()[1:-1] for line in out.splitlines() if line.strip().startswith('[')]
+        for driver in drivers:
+            if self.icat_database_type in driver.lower():
+                return driver
+        if drivers:
+            return drivers[0]
+        raise RuntimeError('no ODBC driver registered for {0}'.format(self.icat_database_type))
+
     def post_install_configuration(self):
         #univmss_interface = '/var/lib/irods/msiExecCmd_bin/univMSSInterface.sh'
         #if os.path.exists(univmss_interface):
@@ -330,15 +365,30 @@ yes
                     f.write('RemoteZoneSID {0}-{1}\n'.format(e['zone_name'], e['zone_key']))
 
     def install_mysql_pcre(self, dependencies, mysql_service):
+        plugin_directory = self.get_mysql_variable('plugin_dir')
+        cache_directory = get_artifact_cache_directory(self.artifact_cache_root_directory, 'lib_mysqludf_preg', get_irods_platform_string(), self.get_mysql_variable('version'))
+        if cache_directory and os.path.exists(cache_directory):
+            self.module.run_command(['sudo', 'cp', os.path.join(cache_directory, 'lib_mysqludf_preg.so'), plugin_directory], check_rc=True)
+            installdb_directory = cache_directory
+        else:
+            installdb_directory = self.build_mysql_pcre(dependencies)
+            if cache_directory:
+                publish_to_artifact_cache([os.path.join(plugin_directory, 'lib_mysqludf_preg.so'), os.path.join(installdb_directory, 'installdb.sql')], cache_directory)
+        self.module.run_command('mysql --user=root --password="password" < installdb.sql', use_unsafe_shell=True, cwd=installdb_directory, check_rc=True)
+        self.module.run_command(['sudo', 'service', mysql_service, 'restart'], check_rc=True)
+
+    def build_mysql_pcre(self, dependencies):
         install_os_packages(dependencies)
         local_pcre_git_dir = os.path.expanduser('~/lib_mysqludf_preg')
-        self.module.run_command(['git', 'clone', 'https://github.com/mysqludf/lib_mysqludf_preg.git', local_pcre_git_dir], check_rc=True)
-        self.module.run_command(['git', 'checkout', 'lib_mysqludf_preg-1.1'], cwd=local_pcre_git_dir, check_rc=True)
+        git_clone('https://github.com/mysqludf/lib_mysqludf_preg.git', 'lib_mysqludf_preg-1.1', local_pcre_git_dir, shallow=True)
         self.module.run_command(['autoreconf', '--force', '--install'], cwd=local_pcre_git_dir, check_rc=True)
         self.module.run_command(['sudo', './configure'], cwd=local_pcre_git_dir, check_rc=True)
         self.module.run_command(['sudo', 'make', 'install'], cwd=local_pcre_git_dir, check_rc=True)
-        self.module.run_command('mysql --user=root --password="password" < installdb.sql', use_unsafe_shell=True, cwd=local_pcre_git_dir, check_rc=True)
-        self.module.run_command(['sudo', 'service', mysql_service, 'restart'], check_rc=True)
+        return local_pcre_git_dir
+
+    def get_mysql_variable(self, name):
+        _, out, _ = self.module.run_command(['mysql', '--user=root', '--password=password', '--skip-column-names', '-e', 'select @@{0}'.format(name)], check_rc=True)
+        return out.strip()
 
 class RedHatStrategy(GenericStrategy):
     @property
@@ -352,13 +402,9 @@ class RedHatStrategy(GenericStrategy):
         self.install_oracle_plugin()
 
     def install_oracle_dependencies(self):
-        tar_file = os.path.expanduser('~/oci.tar')
-        self.module.run_command(['wget', 'http://people.renci.org/~jasonc/irods/oci.tar', '-O', tar_file], check_rc=True)
-        tar_dir = os.path.expanduser('~/oci')
-        os.mkdir(tar_dir)
-        self.module.run_command(['tar', '-xf', tar_file, '-C', tar_dir], check_rc=True)
+        oci_dir = fetch_oracle_instant_client_packages()
         install_os_packages(['unixODBC'])
-        self.module.run_command('sudo rpm -i --nodeps {0}/*'.format(tar_dir), use_unsafe_shell=True, check_rc=True)
+        self.module.run_command('sudo rpm -i --nodeps {0}/*'.format(oci_dir), use_unsafe_shell=True, check_rc=True)
         self.module.run_command(['sudo', 'ln', '-s', '/usr/lib64/libodbcinst.so.2', '/usr/lib64/libodbcinst.so.1'], check_rc=True)
 
     def install_oracle_plugin(self):
@@ -455,13 +501,9 @@ class DebianStrategy(GenericStrategy):
         return super(DebianStrategy, self).install_database_plugin()
 
     def install_oracle_dependencies(self):
-        tar_file = os.path.expanduser('~/oci.tar')
-        self.module.run_command(['wget', 'http://people.renci.org/~jasonc/irods/oci.tar', '-O', tar_file], check_rc=True)
-        tar_dir = os.path.expanduser('~/oci')
-        os.mkdir(tar_dir)
-        self.module.run_command(['tar', '-xf', tar_file, '-C', tar_dir], check_rc=True)
+        oci_dir = fetch_oracle_instant_client_packages()
         install_os_packages(['alien', 'libaio1'])
-        self.module.run_command('sudo alien -i {0}/*'.format(tar_dir), use_unsafe_shell=True, check_rc=True)
+        self.module.run_command('sudo alien -i {0}/*'.format(oci_dir), use_unsafe_shell=True, check_rc=True)
 
     def install_database(self):
         if self.icat_database_type == 'postgres':
@@ -475,8 +517,7 @@ class DebianStrategy(GenericStrategy):
             self.module.run_command(['sudo', 'service', 'mysql', 'restart'], check_rc=True)
             self.install_mysql_pcre(['libpcre3-dev', 'libmysqlclient-dev', 'build-essential', 'libtool', 'autoconf', 'git'], 'mysql')
             if get_distribution_version_major() == '16':
-                tar_output_dir = tempfile.mkdtemp(prefix='irods_mysql_connector_tar_extraction')
-                self.module.run_command(['tar', 'xf', '/projects/irods/vsphere-testing/externals/mysql-connector-odbc-5.3.7-linux-ubuntu16.04-x86-64bit.tar.gz', '--directory', tar_output_dir], check_rc=True)
+                tar_output_dir = fetch_and_extract_artifact('mysql-connector-odbc-5.3.7-linux-ubuntu16.04-x86-64bit.tar.gz')
                 self.module.run_command(['sudo', 'cp', os.path.join(tar_output_dir, 'mysql-connector-odbc-5.3.7-linux-ubuntu16.04-x86-64bit', 'lib', 'libmyodbc5a.so'), '/usr/lib'], check_rc=True)
                 self.module.run_command(['sudo', 'cp', os.path.join(tar_output_dir, 'mysql-connector-odbc-5.3.7-linux-ubuntu16.04-x86-64bit', 'lib', 'libmyodbc5S.so'), '/usr/lib'], check_rc=True)
                 self.module.run_command(['sudo', 'cp', os.path.join(tar_output_dir, 'mysql-connector-odbc-5.3.7-linux-ubuntu16.04-x86-64bit', 'lib', 'libmyodbc5w.so'), '/usr/lib'], check_rc=True)
@@ -562,6 +603,7 @@ def main():
             mungefs_packages_root_directory=dict(type='str', required=False),
             icat_server=dict(type='dict', required=True),
             install_dev_package=dict(type='bool', required=True),
+            artifact_cache_root_directory=dict(type='str', required=False),
         ),
         supports_check_mode=False,
     )
@@ -573,6 +615,8 @@ def main():
         'changed': True,
         'complex_args': module.params,
         'debug_messages': module.debug_messages,
+        'setup_irods_configuration': module.setup_irods_configuration,
+        'setup_irods_configuration_inputs_sha256': module.setup_irods_configuration_inputs_sha256,
         'irods_platform_string': get_irods_platform_string(),
         'irods_version': get_irods_version(),
     }
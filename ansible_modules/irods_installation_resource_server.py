@@ -44,6 +44,12 @@ class ResourceInstaller(object):
     def install(self):
         return self.strategy.install()
 
+    def prepare(self):
+        return self.strategy.prepare()
+
+    def join_zone(self):
+        return self.strategy.join_zone()
+
 class GenericStrategy(object):
     __metaclass__ = abc.ABCMeta
     def __init__(self, module):
@@ -51,6 +57,8 @@ class GenericStrategy(object):
         self.irods_packages_root_directory = module.params['irods_packages_root_directory']
         self.resource_server = module.params['resource_server']
         self.install_dev_package = module.params['install_dev_package']
+        self.module.setup_irods_configuration = None
+        self.module.setup_irods_configuration_inputs_sha256 = None
 
     @property
     def testing_dependencies(self):
@@ -61,10 +69,17 @@ class GenericStrategy(object):
         return os.path.join(self.irods_packages_root_directory, get_irods_platform_string())
 
     def install(self):
+        self.prepare()
+        self.join_zone()
+
+    # everything that does not need a running ICAT, so it can overlap with the ICAT installation
+    def prepare(self):
         self.install_resource()
+        self.install_testing_dependencies()
+
+    def join_zone(self):
         self.run_setup_script()
         self.post_installation_step()
-        self.install_testing_dependencies()
         self.create_ssh_dir()
 
     def install_testing_dependencies(self):
@@ -80,7 +95,7 @@ class GenericStrategy(object):
 
     def install_pip(self):
         local_pip_git_dir = os.path.expanduser('~/pip')
-        git_clone('https://github.com/pypa/pip.git', '10.0.1', local_pip_git_dir)
+        git_clone('https://github.com/pypa/pip.git', '10.0.1', local_pip_git_dir, shallow=True)
         self.module.run_command(['sudo', '-E', 'python', 'setup.py', 'install'], cwd=local_pip_git_dir, check_rc=True)
 
     def install_resource(self):
@@ -103,6 +118,9 @@ class GenericStrategy(object):
             install_os_packages_from_files([dev_package])
 
     def run_setup_script(self):
+        if irods_setup_script_supports_json_configuration():
+            return self.run_setup_script_unattended()
+
         if os.path.exists('/var/lib/irods/scripts/setup_irods.py'):
             setup_input_template = '''\
 {service_account_name}
@@ -195,6 +213,13 @@ yes
             return 'python /var/lib/irods/scripts/setup_irods.py'
         self.module.run_command(['sudo', 'su', '-c', '{0} 2>&1 | tee {1}; exit $PIPESTATUS'.format(get_setup_script_location(), output_log)], data=setup_input, use_unsafe_shell=True, check_rc=True)
 
+    def run_setup_script_unattended(self):
+        default_resource_name = '{0}Resource'.format(socket.gethostname().split('.')[0])
+        setup_configuration, inputs_sha256 = get_irods_setup_configuration(self.resource_server.get('deployment_information', {}), self.resource_server['server_config'], 'consumer', self.resource_server['server_config']['icat_host'], default_resource_name, 'rods')
+        self.module.setup_irods_configuration = setup_configuration
+        self.module.setup_irods_configuration_inputs_sha256 = inputs_sha256
+        run_irods_setup_script_with_json_configuration(setup_configuration, '/var/lib/irods/log/setup_irods.output')
+
     def post_installation_step(self):
         univmss_interface = '/var/lib/irods/msiExecCmd_bin/univMSSInterface.sh'
         if os.path.exists(univmss_interface):
@@ -274,17 +299,25 @@ def main():
             irods_packages_root_directory=dict(type='str', required=True),
             resource_server=dict(type='dict', required=True),
             install_dev_package=dict(type='bool', required=True),
+            phase=dict(choices=['all', 'prepare', 'join_zone'], type='str', default='all'),
         ),
         supports_check_mode=False,
     )
 
     installer = ResourceInstaller(module)
-    installer.install()
+    if module.params['phase'] == 'prepare':
+        installer.prepare()
+    elif module.params['phase'] == 'join_zone':
+        installer.join_zone()
+    else:
+        installer.install()
 
     result = {
         'changed': True,
         'complex_args': module.params,
         'irods_version': get_irods_version(),
+        'setup_irods_configuration': module.setup_irods_configuration,
+        'setup_irods_configuration_inputs_sha256': module.setup_irods_configuration_inputs_sha256,
     }
 
     module.exit_json(**result)
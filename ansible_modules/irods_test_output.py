@@ -0,0 +1,68 @@
+#!/usr/bin/python
+
+import errno
+import json
+import os
+
+
+# reads from offset to the end of the file, or from the start when it is no longer the file inode refers to
+def read_test_output(offset, inode):
+    test_output_file = get_irods_test_output_file()
+    try:
+        st = os.stat(test_output_file)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return {'exists': False, 'inode': None, 'size': 0, 'offset': 0, 'data': ''}
+
+    if st.st_ino != inode or st.st_size < offset: # irods_testing started a new file
+        offset = 0
+    with open(test_output_file) as f:
+        f.seek(offset)
+        data = f.read()
+    return {
+        'exists': True,
+        'inode': st.st_ino,
+        'size': st.st_size,
+        'offset': offset + len(data),
+        'data': data.decode('utf-8', 'replace'),
+    }
+
+# what async_status would report for the background job writing async_job_file
+def get_async_job_status(async_job_file):
+    try:
+        with open(os.path.expanduser(async_job_file)) as f:
+            status = json.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return {'finished': 0}
+    except ValueError: # still being written
+        return {'finished': 0}
+    if 'started' in status:
+        return {'finished': 0}
+    status['finished'] = 1
+    return status
+
+def main():
+    module = AnsibleModule(
+        argument_spec = dict(
+            offset=dict(type='int', default=0),
+            inode=dict(type='int'),
+            async_job_file=dict(type='str'),
+        ),
+        supports_check_mode=False,
+    )
+
+    # the job status is read first, so a finished job's output is always read completely
+    job = get_async_job_status(module.params['async_job_file']) if module.params['async_job_file'] else None
+    result = read_test_output(module.params['offset'], module.params['inode'])
+    result['job'] = job
+    result['changed'] = False
+    result['complex_args'] = module.params
+    module.exit_json(**result)
+
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.local_ansible_utils_extension import *
+main()
@@ -6,9 +6,16 @@ import pwd
 import socket
 import shutil
 import subprocess
+import threading
+import time
+import xml.etree.ElementTree
 
 
-def run_tests(test_type, use_ssl, use_mungefs, output_directory, federation_args):
+# attempt > 0 reruns test_identifiers after a failed attempt: its output is appended to test_output.txt and
+# its reports are kept in test-reports.attempt<N>, leaving test-reports with the original results.
+# test_partitions, lists of test identifiers, run concurrently against this zone (see run_test_partitions).
+# Returns the return code and the failed tests ("module.Class.test") found in this attempt's reports.
+def run_tests(test_type, use_ssl, use_mungefs, output_directory, federation_args, test_identifiers, run_suite_extras, attempt, test_partitions):
     if test_type != 'federation':
         create_irodsauthuser_account()
 
@@ -19,11 +26,14 @@ def run_tests(test_type, use_ssl, use_mungefs, output_directory, federation_args
         'federation': '--run_specific_test test_federation --federation {0}'.format(' '.join(federation_args)),
     }
     test_type_argument = test_type_dict[test_type]
+    test_selection_arguments = [test_type_argument]
+    if test_identifiers:
+        test_selection_arguments = get_test_selection_arguments(test_type_argument, test_identifiers, run_suite_extras)
 
-    if get_irods_version() < (4, 2):
-        test_output_file = '/var/lib/irods/tests/test_output.txt'
-    else:
-        test_output_file = '/var/lib/irods/test/test_output.txt'
+    test_output_file = get_irods_test_output_file()
+    if attempt == 0:
+        # a fresh file tells the controller's tail (irods_test_output) that a new run started
+        subprocess.call(['sudo', 'rm', '-f', test_output_file, irods_testing_abort_file])
     if test_type == 'federation':
         if get_irods_version() < (4, 0): # we are running copied code on an old zone
             subprocess_get_output(['sudo', 'su', '-', 'irods', '-c', 'mkdir -p /var/lib/irods/tests'], check_rc=True)
@@ -33,18 +43,194 @@ def run_tests(test_type, use_ssl, use_mungefs, output_directory, federation_args
 
     ssl_string = '--use_ssl' if use_ssl else ''
     munge_string = '--use_mungefs' if use_mungefs else ''
-    devtesty_string = '--run_devtesty' if not use_ssl and not test_type == 'federation' else ''
+    devtesty_string = '--run_devtesty' if not use_ssl and not test_type == 'federation' and run_suite_extras else ''
 
     test_runner_directory = get_test_runner_directory()
+    test_reports_directory = os.path.join(test_runner_directory, 'test-reports')
+    original_test_reports_directory = test_reports_directory + '.original'
+    if attempt > 0 and os.path.exists(test_reports_directory):
+        subprocess_get_output(['sudo', 'mv', test_reports_directory, original_test_reports_directory], check_rc=True)
+
+    run_start = time.time()
+    if test_partitions and attempt == 0:
+        test_identifiers = sum(test_partitions, [])
+        test_partitions, unpartitioned_tests = split_partition_unsafe_tests(test_runner_directory, test_partitions)
+        partition_selection_arguments = []
+        for i, partition in enumerate(test_partitions):
+            partition_selection_arguments.append(get_test_selection_arguments(test_type_argument, partition, run_suite_extras and i == 0))
+        returncode = 0
+        if partition_selection_arguments:
+            returncode = run_test_partitions(test_runner_directory, partition_selection_arguments, ssl_string, munge_string, devtesty_string, test_output_file)
+            devtesty_string = ''
+        if unpartitioned_tests:
+            unpartitioned_returncode = run_test_selection_arguments(test_runner_directory, get_test_selection_arguments(test_type_argument, unpartitioned_tests, run_suite_extras and not partition_selection_arguments),
+                                                                    ssl_string, munge_string, devtesty_string, '>>', test_output_file)
+            returncode = returncode or unpartitioned_returncode
+    else:
+        returncode = run_test_selection_arguments(test_runner_directory, test_selection_arguments, ssl_string, munge_string, devtesty_string, '>' if attempt == 0 else '>>', test_output_file)
+
+    failed_tests = get_failed_tests(test_reports_directory, run_start)
+    if attempt > 0:
+        if os.path.exists(test_reports_directory):
+            subprocess_get_output(['sudo', 'mv', test_reports_directory, '{0}.attempt{1}'.format(test_reports_directory, attempt)], check_rc=True)
+        if os.path.exists(original_test_reports_directory):
+            subprocess_get_output(['sudo', 'mv', original_test_reports_directory, test_reports_directory], check_rc=True)
 
-    returncode = subprocess.call('sudo su - irods -c "cd {0}; python run_tests.py --xml_output {1} {2} {3} {4}> {5} 2>&1"'.format(test_runner_directory, test_type_argument, ssl_string, munge_string, devtesty_string, test_output_file), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     if output_directory:
         output_directory_os_specific = os.path.join(output_directory, socket.gethostname())
-        os.makedirs(output_directory_os_specific)
+        if not os.path.exists(output_directory_os_specific):
+            os.makedirs(output_directory_os_specific)
         shutil.copy(test_output_file, output_directory_os_specific)
+        if test_identifiers and attempt == 0:
+            shutil.copytree(test_reports_directory, os.path.join(output_directory_os_specific, 'test-reports'))
+
+    return returncode, failed_tests
+
+def run_test_selection_arguments(test_runner_directory, test_selection_arguments, ssl_string, munge_string, devtesty_string, redirection, test_output_file):
+    returncode = 0
+    for test_selection_argument in test_selection_arguments:
+        if os.path.exists(irods_testing_abort_file): # the controller's failure threshold was reached
+            return returncode or 1
+        run_returncode = subprocess.call('sudo su - irods -c "cd {0}; python run_tests.py --xml_output {1} {2} {3} {4}{5} {6} 2>&1"'.format(test_runner_directory, test_selection_argument, ssl_string, munge_string, devtesty_string, redirection, test_output_file), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        returncode = returncode or run_returncode
+        devtesty_string = ''
+        redirection = '>>'
+    return returncode
+
+# The test sessions (make_sessions_mixin, ResourceBase) create and remove the same fixed users and resources
+# in every module, so partitions after the first run from a copy of the test runner tree in which those names
+# carry a per-partition suffix. The sessions then create the renamed users and resources themselves in setUp.
+# If a copy can't be isolated the partitions are run one after another instead. The partitions' output lines
+# are appended to test_output_file as they come, so the controller's tail and failure threshold follow the run;
+# each partition's test-reports are copied back into the runner's afterwards. The devtesty and auth tests ride
+# along with the first partition.
+partition_shared_test_names = ['alice', 'bobby', 'otherrods', 'zonehopper', 'TestResc', 'AnotherResc']
+
+# modules mentioning these restart the server or edit server_config.json, which renaming can't isolate and
+# which would disturb every partition running beside them, so they run on their own after the partitions
+partition_unsafe_test_markers = ['server_config', 'restart', 'irodsctl', 'IrodsController', 'start_irods', 'stop_irods']
+
+# returns (the partitions without partition-unsafe tests, the partition-unsafe tests)
+def split_partition_unsafe_tests(test_runner_directory, test_partitions):
+    partitions = []
+    unpartitioned_tests = []
+    for partition in test_partitions:
+        partitions.append([t for t in partition if is_partition_safe(test_runner_directory, t)])
+        unpartitioned_tests.extend(t for t in partition if t not in partitions[-1])
+    return [partition for partition in partitions if partition], unpartitioned_tests
+
+def is_partition_safe(test_runner_directory, test_identifier):
+    module_name = test_identifier.split('.')[0]
+    for test_module in [os.path.join(test_runner_directory, 'irods', 'test', module_name + '.py'), os.path.join(test_runner_directory, module_name + '.py')]:
+        try:
+            with open(test_module) as f:
+                source = f.read()
+        except IOError:
+            continue
+        return not any(marker in source for marker in partition_unsafe_test_markers)
+    return False
+
+# appends whole lines from the concurrent partitions to the test output file, which stays owned by irods
+class TestOutputAppender(object):
+    def __init__(self, test_output_file):
+        subprocess_get_output(['sudo', 'su', '-', 'irods', '-c', 'touch {0}'.format(test_output_file)], check_rc=True)
+        self.devnull = open(os.devnull, 'w')
+        self.tee = subprocess.Popen(['sudo', '-u', 'irods', 'tee', '-a', test_output_file], stdin=subprocess.PIPE, stdout=self.devnull)
+        self.lock = threading.Lock()
 
+    def append(self, line):
+        with self.lock:
+            self.tee.stdin.write(line)
+            self.tee.stdin.flush()
+
+    def close(self):
+        self.tee.stdin.close()
+        self.tee.wait()
+        self.devnull.close()
+
+def run_test_partitions(test_runner_directory, partition_selection_arguments, ssl_string, munge_string, devtesty_string, test_output_file):
+    partitions_directory = '/var/lib/irods/test_partitions'
+    partition_directories = [test_runner_directory]
+    for i in range(1, len(partition_selection_arguments)):
+        partition_directory = os.path.join(partitions_directory, str(i), os.path.basename(test_runner_directory))
+        subprocess_get_output(['sudo', 'su', '-', 'irods', '-c', 'rm -rf {0}; mkdir -p {1}; cp -a {2} {0}; rm -rf {0}/test-reports'.format(
+            partition_directory, os.path.dirname(partition_directory), test_runner_directory)], check_rc=True)
+        if not isolate_test_partition(partition_directory, '_p{0}'.format(i)):
+            subprocess_get_output(['sudo', 'su', '-', 'irods', '-c', 'echo "test partition {0} could not be isolated, running the partitions one after another" > {1}'.format(i, test_output_file)], check_rc=True)
+            return run_test_selection_arguments(test_runner_directory, sum(partition_selection_arguments, []), ssl_string, munge_string, devtesty_string, '>>', test_output_file)
+        partition_directories.append(partition_directory)
+
+    test_output = TestOutputAppender(test_output_file)
+    returncodes = [1] * len(partition_selection_arguments)
+    def run_partition(i):
+        returncodes[i] = run_partition_test_selection_arguments(partition_directories[i], partition_selection_arguments[i], ssl_string, munge_string,
+                                                                devtesty_string if i == 0 else '', test_output)
+    threads = [threading.Thread(target=run_partition, args=(i,)) for i in range(len(partition_selection_arguments))]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        test_output.close()
+
+    merge_commands = []
+    for partition_directory in partition_directories[1:]:
+        merge_commands.append('if [ -d {0}/test-reports ]; then mkdir -p {1}/test-reports; cp {0}/test-reports/* {1}/test-reports/; fi'.format(partition_directory, test_runner_directory))
+    subprocess_get_output(['sudo', 'su', '-', 'irods', '-c', '; '.join(merge_commands)], check_rc=True)
+
+    for returncode in returncodes:
+        if returncode != 0:
+            return returncode
+    return 0
+
+def run_partition_test_selection_arguments(test_runner_directory, test_selection_arguments, ssl_string, munge_string, devtesty_string, test_output):
+    returncode = 0
+    for test_selection_argument in test_selection_arguments:
+        if os.path.exists(irods_testing_abort_file): # the controller's failure threshold was reached
+            return returncode or 1
+        p = subprocess.Popen('sudo su - irods -c "cd {0}; python run_tests.py --xml_output {1} {2} {3} {4} 2>&1"'.format(test_runner_directory, test_selection_argument, ssl_string, munge_string, devtesty_string), shell=True, stdout=subprocess.PIPE)
+        for line in iter(p.stdout.readline, ''):
+            test_output.append(line)
+        returncode = returncode or p.wait()
+        devtesty_string = ''
     return returncode
 
+# renames the shared session users and resources in the copy's test code, True if the session users were found
+def isolate_test_partition(partition_directory, suffix):
+    sed_expressions = []
+    for name in partition_shared_test_names:
+        for quote in ["'", '"']:
+            sed_expressions += ['-e', 's/{0}{1}{0}/{0}{1}{2}{0}/g'.format(quote, name, suffix)]
+    subprocess_get_output(['sudo', '-u', 'irods', 'find', partition_directory, '-name', '*.py', '-exec', 'sed', '-i'] + sed_expressions + ['{}', '+'], check_rc=True)
+    returncode, _, _ = subprocess_get_output(['sudo', '-u', 'irods', 'grep', '-rqF', '--include=*.py', "'alice{0}'".format(suffix), partition_directory])
+    return returncode == 0
+
+# reports older than this run are left over from earlier invocations on the host
+def get_failed_tests(test_reports_directory, run_start):
+    failed_tests = []
+    if not os.path.isdir(test_reports_directory):
+        return failed_tests
+    for basename in sorted(os.listdir(test_reports_directory)):
+        report = os.path.join(test_reports_directory, basename)
+        if not basename.endswith('.xml') or os.path.getmtime(report) < run_start:
+            continue
+        for testcase in xml.etree.ElementTree.parse(report).getiterator('testcase'):
+            if testcase.find('failure') is not None or testcase.find('error') is not None:
+                failed_tests.append('{0}.{1}'.format(testcase.get('classname'), testcase.get('name')))
+    return failed_tests
+
+# run_tests.py only takes a single --run_specific_test, so a shard is one run per test module.
+# The auth tests are appended by run_tests.py to whatever is selected, so they ride along with the first run only.
+def get_test_selection_arguments(test_type_argument, test_identifiers, run_suite_extras):
+    common_arguments = [a for a in test_type_argument.split() if a not in ['--run_python_suite', '--include_auth_tests']]
+    extra_arguments = ['--include_auth_tests'] if run_suite_extras and '--include_auth_tests' in test_type_argument else []
+    test_selection_arguments = []
+    for test_identifier in test_identifiers:
+        test_selection_arguments.append(' '.join(['--run_specific_test', test_identifier] + common_arguments + extra_arguments))
+        extra_arguments = []
+    return test_selection_arguments
+
 def create_irodsauthuser_account():
     name, password = get_authuser_name_and_password()
     try:
@@ -76,15 +262,6 @@ def get_authuser_name_and_password():
             return 'irodsauthuser', 'iamnotasecret'
         raise
 
-def get_test_runner_directory():
-    test_directories = ['/var/lib/irods/scripts',
-                        '/var/lib/irods/tests/pydevtest',]
-    for l in test_directories:
-        if os.path.exists(os.path.join(l, 'run_tests.py')):
-            return l
-
-    raise RuntimeError('failed to find run_tests.py')
-
 def main():
     module = AnsibleModule(
         argument_spec = dict(
@@ -93,16 +270,23 @@ def main():
             use_ssl=dict(type='bool', required=True),
             use_mungefs=dict(type='bool', required=True),
             federation_args=dict(type='list', default=[]),
+            test_identifiers=dict(type='list', default=[]),
+            run_suite_extras=dict(type='bool', default=True),
+            attempt=dict(type='int', default=0),
+            test_partitions=dict(type='list', default=[]),
         ),
         supports_check_mode=False,
     )
 
-    test_returncode = run_tests(module.params['test_type'], module.params['use_ssl'], module.params['use_mungefs'], module.params['output_directory'], module.params['federation_args'])
+    test_returncode, failed_tests = run_tests(module.params['test_type'], module.params['use_ssl'], module.params['use_mungefs'], module.params['output_directory'], module.params['federation_args'],
+                                              module.params['test_identifiers'], module.params['run_suite_extras'], module.params['attempt'],
+                                              module.params['test_partitions'])
 
     result = {}
     result['changed'] = True
     result['complex_args'] = module.params
     result['tests_passed'] = test_returncode == 0
+    result['failed_tests'] = failed_tests
 
     module.exit_json(**result)
 
@@ -0,0 +1,36 @@
+#!/usr/bin/python
+
+import pipes
+
+
+pydevtest_files = ['run_tests.py', 'configuration.py', 'test_federation.py', 'lib.py', 'test_framework_configuration.json']
+
+# Runs on the target ICAT and pulls the test tree straight from source_host as one tar stream over the
+# irods service account's ssh key (see create_ssh_keys.share_ssh_keys). Ownership and permissions are
+# set in the archive headers, so the extraction needs no separate chown/chmod pass.
+def transfer_testing_code(module, source_host):
+    tar_create = 'tar -C /var/lib/irods --owner=irods --group=irods --mode=a+rwX'
+    pydevtest_paths = ['tests', 'tests/pydevtest'] + ['tests/pydevtest/' + f for f in pydevtest_files]
+    remote_command = 'if [ -e /var/lib/irods/scripts/run_tests.py ]; then {0} -cf - scripts; else {0} --no-recursion -cf - {1}; fi'.format(tar_create, ' '.join(pydevtest_paths))
+    ssh_command = 'ssh -o BatchMode=yes -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null irods@{0} {1}'.format(source_host, pipes.quote(remote_command))
+    pipeline = 'su - irods -c {0} | tar -C /var/lib/irods -xpf -'.format(pipes.quote(ssh_command))
+    module.run_command(['bash', '-o', 'pipefail', '-c', pipeline], check_rc=True)
+
+def main():
+    module = AnsibleModule(
+        argument_spec = dict(
+            source_host=dict(type='str', required=True),
+        ),
+        supports_check_mode=False,
+    )
+
+    transfer_testing_code(module, module.params['source_host'])
+
+    result = {}
+    result['changed'] = True
+    result['complex_args'] = module.params
+    module.exit_json(**result)
+
+
+from ansible.module_utils.basic import *
+main()
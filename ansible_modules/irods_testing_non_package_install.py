@@ -15,16 +15,16 @@ pip_install_irods_python_ci_utilities()
 import irods_python_ci_utilities as ci
 
 
-def do(irods_repository, irods_commitish, icommands_repository, icommands_commitish, output_directory):
+def do(irods_repository, irods_commitish, icommands_repository, icommands_commitish, output_directory, artifact_cache_root_directory=None):
     install_building_dependencies()
 
-    irods_git_dir = ci.git_clone(irods_repository, irods_commitish)
-    install_irods_externals_dependencies(irods_git_dir)
+    irods_git_dir = git_clone(irods_repository, irods_commitish)
+    install_irods_externals_dependencies(irods_git_dir, artifact_cache_root_directory)
     irods_build_dir = tempfile.mkdtemp(prefix='irods_build_dir')
     irods_install_dir = tempfile.mkdtemp(prefix='irods_install_dir')
     build_irods(irods_git_dir, irods_build_dir, irods_install_dir)
 
-    icommands_git_dir = ci.git_clone(icommands_repository, icommands_commitish)
+    icommands_git_dir = git_clone(icommands_repository, icommands_commitish)
     icommands_build_dir = tempfile.mkdtemp(prefix='icommands_build_dir')
     build_icommands(icommands_git_dir, icommands_build_dir, irods_install_dir)
 
@@ -71,8 +71,8 @@ def install_building_dependencies_suse():
     ci.subprocess_get_output(['sudo', 'zypper', '--gpg-auto-import-keys', 'refresh'], check_rc=True)
     ci.install_os_packages(['git', 'python-devel', 'help2man', 'unixODBC', 'fuse-devel', 'libcurl-devel', 'libbz2-devel', 'libopenssl-devel', 'libxml2-devel', 'krb5-devel', 'perl-JSON', 'unixODBC-devel', 'python-psutil', 'fakeroot'])
 
-def install_irods_externals_dependencies(irods_git_dir):
-    ci.install_irods_core_dev_repository()
+def install_irods_externals_dependencies(irods_git_dir, artifact_cache_root_directory=None):
+    install_irods_repository(get_local_package_repository_directory(artifact_cache_root_directory))
     with open(os.path.join(irods_git_dir, 'externals.json')) as f:
         d = json.load(f)
     ci.install_os_packages([d['cmake']] + d['others'])
@@ -81,12 +81,12 @@ def install_irods_externals_dependencies(irods_git_dir):
 
 def build_irods(irods_git_dir, irods_build_dir, irods_install_dir):
     ci.subprocess_get_output('cmake {0} -DCMAKE_INSTALL_PREFIX={1} > cmake_irods.output'.format(irods_git_dir, irods_install_dir), cwd=irods_build_dir, shell=True, check_rc=True)
-    ci.subprocess_get_output('make -j4 non-package-install-postgres > make_irods.output', cwd=irods_build_dir, shell=True, check_rc=True)
+    ci.subprocess_get_output('make -j{0} non-package-install-postgres > make_irods.output'.format(get_build_parallelism()), cwd=irods_build_dir, shell=True, check_rc=True)
 
 def build_icommands(icommands_git_dir, icommands_build_dir, irods_install_dir):
     IRODS_DIR = os.path.join(irods_install_dir, 'usr/lib/irods/cmake')
     ci.subprocess_get_output('cmake {0} -DCMAKE_INSTALL_PREFIX={1} -DIRODS_DIR={2} > cmake_icommands.output'.format(icommands_git_dir, irods_install_dir, IRODS_DIR), cwd=icommands_build_dir, shell=True, check_rc=True)
-    ci.subprocess_get_output('make -j4 install > make_icommands.output', cwd=icommands_build_dir, shell=True, check_rc=True)
+    ci.subprocess_get_output('make -j{0} install > make_icommands.output'.format(get_build_parallelism()), cwd=icommands_build_dir, shell=True, check_rc=True)
 
 def configure_database():
     ci.subprocess_get_output(['sudo', 'su', '-', 'postgres', '-c', 'createuser -s irods'], check_rc=True)
@@ -134,11 +134,12 @@ def main():
             icommands_git_repository=dict(type='str', required=True),
             icommands_git_commitish=dict(type='str', required=True),
             debug_build=dict(type='bool', required=True),
+            artifact_cache_root_directory=dict(type='str', required=False),
         ),
         supports_check_mode=False,
     )
 
-    do(module.params['irods_git_repository'], module.params['irods_git_commitish'], module.params['icommands_git_repository'], module.params['icommands_git_commitish'], module.params['output_directory'])
+    do(module.params['irods_git_repository'], module.params['irods_git_commitish'], module.params['icommands_git_repository'], module.params['icommands_git_commitish'], module.params['output_directory'], module.params['artifact_cache_root_directory'])
 
     result = {}
     result['changed'] = True
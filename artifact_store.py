@@ -0,0 +1,198 @@
+import argparse
+import contextlib
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import time
+
+import configuration
+import library
+
+
+def get_gathered_artifact_store_directory():
+    # optional, gathered files are kept once per distinct content here instead of in every output directory
+    return getattr(configuration, 'gathered_artifact_store_directory', None)
+
+def get_blob_path(store_directory, sha256):
+    return os.path.join(store_directory, 'blobs', sha256[:2], sha256 + '.gz')
+
+def get_run_manifest_path(store_directory, run_id):
+    return os.path.join(store_directory, 'runs', run_id + '.json')
+
+def load_run_manifest(store_directory, run_id):
+    with open(get_run_manifest_path(store_directory, run_id)) as f:
+        return json.load(f)
+
+def list_run_manifests(store_directory):
+    run_manifests = []
+    for run_manifest_path in sorted(glob.glob(os.path.join(store_directory, 'runs', '*.json'))):
+        with open(run_manifest_path) as f:
+            run_manifests.append(json.load(f))
+    return run_manifests
+
+# Returns the digest the file was stored under and whether it was new. The digest is always the one
+# computed while reading fileobj, so a blob is only ever named after its own content.
+def store_blob(store_directory, fileobj):
+    temp_directory = os.path.join(store_directory, 'blobs', 'tmp')
+    library.makedirs_catch_preexisting(temp_directory)
+    fd, temp_blob = tempfile.mkstemp(dir=temp_directory)
+    h = hashlib.sha256()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            with contextlib.closing(gzip.GzipFile(fileobj=f, mode='wb')) as g:
+                for chunk in iter(lambda: fileobj.read(1024*1024), b''):
+                    h.update(chunk)
+                    g.write(chunk)
+        sha256 = h.hexdigest()
+        blob = get_blob_path(store_directory, sha256)
+        if os.path.exists(blob):
+            os.utime(blob, None) # keeps a blob this run references from being collected as unreferenced
+            return sha256, False
+        library.makedirs_catch_preexisting(os.path.dirname(blob))
+        os.rename(temp_blob, blob)
+        return sha256, True
+    finally:
+        if os.path.exists(temp_blob):
+            os.unlink(temp_blob)
+
+# Moves the archives irods_gathering wrote into output_root_directory into the store, leaving
+# gathered_artifacts.json there to find them again (see gather.iterate_gathered_host_files)
+def store_gathered_archives(output_root_directory, run_name, store_directory=None):
+    logger = logging.getLogger(__name__)
+    if store_directory is None:
+        store_directory = get_gathered_artifact_store_directory()
+    run_id = '{0}-{1}'.format(re.sub(r'[^\w.-]', '_', run_name), time.strftime('%Y%m%dT%H%M%S'))
+    run_manifest = {
+        'run_id': run_id,
+        'run_name': run_name,
+        'recorded_at': time.time(),
+        'hosts': {},
+    }
+
+    manifest_files = sorted(glob.glob(os.path.join(output_root_directory, '*.manifest.json')))
+    new_blobs = 0
+    new_bytes = 0
+    total_bytes = 0
+    for manifest_file in manifest_files:
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        stored_files = {}
+        with contextlib.closing(tarfile.open(os.path.join(output_root_directory, manifest['archive']), 'r:gz')) as t:
+            for member in t:
+                if not member.isfile():
+                    continue
+                path = '/' + member.name
+                sha256, new = store_blob(store_directory, t.extractfile(member))
+                stored_files[path] = {'sha256': sha256, 'size': member.size, 'mtime': member.mtime}
+                total_bytes += member.size
+                if new:
+                    new_blobs += 1
+                    new_bytes += member.size
+        run_manifest['hosts'][manifest['hostname']] = stored_files
+
+    library.makedirs_catch_preexisting(os.path.join(store_directory, 'runs'))
+    library.write_file_atomically(get_run_manifest_path(store_directory, run_id), json.dumps(run_manifest, indent=4, sort_keys=True))
+    library.write_file_atomically(os.path.join(output_root_directory, 'gathered_artifacts.json'), json.dumps({'store_directory': store_directory, 'run_id': run_id}, indent=4, sort_keys=True))
+    for manifest_file in manifest_files:
+        os.unlink(manifest_file[:-len('.manifest.json')] + '.tar.gz')
+        os.unlink(manifest_file)
+    logger.info('stored gathered files of %d hosts as run [%s], %d new blobs, %d of %d bytes new', len(manifest_files), run_id, new_blobs, new_bytes, total_bytes)
+    return run_id
+
+# yields (path on the server, file object, mtime on the server) for the stored files of hostname whose path satisfies predicate
+def iterate_stored_files(store_directory, run_id, hostname, predicate):
+    hosts = load_run_manifest(store_directory, run_id)['hosts']
+    for name in [hostname, hostname.split('.')[0]]:
+        if name in hosts:
+            break
+    else:
+        return
+    for path, stored_file in sorted(hosts[name].items()):
+        if predicate(path):
+            with contextlib.closing(gzip.GzipFile(get_blob_path(store_directory, stored_file['sha256']), 'rb')) as f:
+                yield path, f, stored_file['mtime']
+
+def restore_run(store_directory, run_id, destination_directory):
+    for hostname, stored_files in load_run_manifest(store_directory, run_id)['hosts'].items():
+        for path, stored_file in stored_files.items():
+            destination = os.path.join(destination_directory, hostname, path.lstrip('/'))
+            library.makedirs_catch_preexisting(os.path.dirname(destination))
+            with contextlib.closing(gzip.GzipFile(get_blob_path(store_directory, stored_file['sha256']), 'rb')) as source:
+                with open(destination, 'wb') as f:
+                    shutil.copyfileobj(source, f)
+            os.utime(destination, (stored_file['mtime'], stored_file['mtime']))
+
+# Expires runs older than retention_days, except the keep_latest newest of each run name, then removes
+# the blobs no remaining run references. Blobs touched within grace_hours are kept, they may belong
+# to a run still being stored.
+def collect_garbage(store_directory, retention_days, keep_latest=1, grace_hours=24, dry_run=False):
+    logger = logging.getLogger(__name__)
+    now = time.time()
+    runs_by_name = {}
+    for run_manifest in list_run_manifests(store_directory):
+        runs_by_name.setdefault(run_manifest['run_name'], []).append(run_manifest)
+
+    referenced = set()
+    expired_runs = []
+    for run_name, run_manifests in runs_by_name.items():
+        run_manifests.sort(key=lambda r: r['recorded_at'], reverse=True)
+        for i, run_manifest in enumerate(run_manifests):
+            if i < keep_latest or now - run_manifest['recorded_at'] < retention_days * 24 * 60 * 60:
+                for stored_files in run_manifest['hosts'].values():
+                    referenced.update(stored_file['sha256'] for stored_file in stored_files.values())
+            else:
+                expired_runs.append(run_manifest['run_id'])
+
+    for run_id in expired_runs:
+        logger.info('expiring run [%s]', run_id)
+        if not dry_run:
+            os.unlink(get_run_manifest_path(store_directory, run_id))
+
+    removed_blobs = 0
+    freed_bytes = 0
+    for blob in glob.glob(os.path.join(store_directory, 'blobs', '*', '*')):
+        sha256 = os.path.basename(blob).split('.')[0]
+        if sha256 in referenced or now - os.path.getmtime(blob) < grace_hours * 60 * 60:
+            continue
+        removed_blobs += 1
+        freed_bytes += os.path.getsize(blob)
+        if not dry_run:
+            os.unlink(blob)
+    logger.info('expired %d runs, removed %d unreferenced blobs, %d bytes freed', len(expired_runs), removed_blobs, freed_bytes)
+    return expired_runs, removed_blobs, freed_bytes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintain the content-addressed store of gathered files')
+    parser.add_argument('--store_directory', type=str, help='defaults to gathered_artifact_store_directory from the configuration')
+    subparsers = parser.add_subparsers(dest='command')
+    gc_parser = subparsers.add_parser('gc', help='expire old runs and remove the files no remaining run references')
+    gc_parser.add_argument('--retention_days', type=float, required=True)
+    gc_parser.add_argument('--keep_latest', type=int, default=1, help='newest runs of each run name kept regardless of age')
+    gc_parser.add_argument('--grace_hours', type=float, default=24)
+    gc_parser.add_argument('--dry_run', action='store_true')
+    restore_parser = subparsers.add_parser('restore', help='write the files of a stored run out as <destination>/<hostname>/<path>')
+    restore_parser.add_argument('--run_id', type=str, required=True)
+    restore_parser.add_argument('--destination_directory', type=str, required=True)
+    subparsers.add_parser('list', help='list the stored runs')
+    args = parser.parse_args()
+
+    library.register_log_handlers()
+
+    store_directory = args.store_directory or get_gathered_artifact_store_directory()
+    if not store_directory:
+        parser.error('no --store_directory given and gathered_artifact_store_directory is not configured')
+
+    if args.command == 'gc':
+        collect_garbage(store_directory, args.retention_days, args.keep_latest, args.grace_hours, args.dry_run)
+    elif args.command == 'restore':
+        restore_run(store_directory, args.run_id, args.destination_directory)
+    else:
+        for run_manifest in list_run_manifests(store_directory):
+            print('{0}\t{1}\t{2}'.format(run_manifest['run_id'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run_manifest['recorded_at'])), ' '.join(sorted(run_manifest['hosts']))))
@@ -0,0 +1,181 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+import library
+
+
+def build(run_name, output_root_directory, git_repository, git_commitish, git_repository_icommands, git_commitish_icommands, debug_build, platform_targets=None, leak_vms=False):
+    if platform_targets is None:
+        platform_targets = [('CentOS', '6'), ('CentOS', '7'), ('Ubuntu', '12'), ('Ubuntu', '14'), ('openSUSE ', '13')]
+
+    logger = logging.getLogger(__name__)
+    irods_sha = resolve_git_commitish(git_repository, git_commitish)
+    icommands_sha = resolve_git_commitish(git_repository_icommands, git_commitish_icommands)
+    store_directory = get_build_artifact_store_directory()
+    library.update_git_mirrors([git_repository, git_repository_icommands])
+
+    platform_targets_to_build = []
+    for platform_target in platform_targets:
+        manifest = None
+        if store_directory and irods_sha and icommands_sha:
+            manifest = load_build_artifact_manifest(store_directory, get_build_artifact_key(irods_sha, icommands_sha, platform_target, debug_build))
+        if manifest:
+            restore_build_artifacts(store_directory, manifest, output_root_directory)
+            logger.info('restored build of irods [%s] icommands [%s] for %s from the build artifact store', irods_sha, icommands_sha, platform_target)
+        else:
+            platform_targets_to_build.append(platform_target)
+
+    if not platform_targets_to_build:
+        return
+
+    complex_args = {
+        'output_root_directory': output_root_directory,
+        'git_repository': git_repository,
+        'git_commitish': irods_sha or git_commitish,
+        'debug_build': debug_build,
+        'git_repository_icommands': git_repository_icommands,
+        'git_commitish_icommands': icommands_sha or git_commitish_icommands,
+        'artifact_cache_root_directory': library.get_artifact_cache_root_directory(),
+    }
+    vm_names, ip_addresses = library.deploy_vms_return_names_and_ips(run_name, platform_targets_to_build)
+    with library.vm_manager(vm_names, leak_vms):
+        library.push_external_artifacts(ip_addresses, get_external_artifacts_for_build(git_repository, irods_sha))
+        data = library.run_ansible(module_name='irods_building', complex_args=complex_args, host_list=ip_addresses)
+
+    if store_directory and irods_sha and icommands_sha:
+        for platform_target, ip_address in zip(platform_targets_to_build, ip_addresses):
+            irods_platform_string = data['contacted'][ip_address]['irods_platform_string']
+            manifest = {
+                'key': get_build_artifact_key(irods_sha, icommands_sha, platform_target, debug_build),
+                'irods_sha': irods_sha,
+                'icommands_sha': icommands_sha,
+                'platform_target': platform_target,
+                'debug_build': debug_build,
+                'irods_platform_string': irods_platform_string,
+            }
+            store_build_artifacts(store_directory, manifest, os.path.join(output_root_directory, irods_platform_string))
+
+# only the legacy build.sh path builds the oracle plugin, the CMake path never reads oci.tar
+def get_external_artifacts_for_build(git_repository, irods_sha):
+    logger = logging.getLogger(__name__)
+    if uses_cmake_build(git_repository, irods_sha):
+        return []
+    if not library.is_external_artifact_pinned('oci.tar'):
+        logger.warning('no sha256 pinned for external artifact [oci.tar], not pushing it, oracle plugin builds will fail')
+        return []
+    return ['oci.tar']
+
+# None when the commit isn't in a local git mirror, the build path is then only known on the VMs
+def uses_cmake_build(git_repository, irods_sha):
+    git_mirror_root_directory = library.get_git_mirror_root_directory()
+    if not git_mirror_root_directory or not irods_sha:
+        return None
+    git_mirror = os.path.join(git_mirror_root_directory, library.get_git_mirror_name(git_repository))
+    if not git_object_exists(git_mirror, irods_sha + '^{commit}'):
+        return None
+    return git_object_exists(git_mirror, irods_sha + ':CMakeLists.txt')
+
+def git_object_exists(git_dir, object_name):
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call(['git', '--git-dir', git_dir, 'cat-file', '-e', object_name], stderr=devnull) == 0
+
+def get_build_artifact_store_directory():
+    artifact_cache_root_directory = library.get_artifact_cache_root_directory()
+    if not artifact_cache_root_directory:
+        return None
+    return os.path.join(artifact_cache_root_directory, 'builds')
+
+def resolve_git_commitish(repository, commitish):
+    if re.match('^[0-9a-f]{40}$', commitish):
+        return commitish
+    p = subprocess.Popen(['git', 'ls-remote', repository, commitish, commitish + '^{}'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    if p.returncode != 0:
+        raise RuntimeError('git ls-remote [{0}] [{1}] failed: {2}'.format(repository, commitish, err))
+    shas_and_refs = [line.split('\t') for line in out.splitlines()]
+    for sha, ref in shas_and_refs:
+        if ref.endswith('^{}'): # annotated tag, use the commit it points to
+            return sha
+    if shas_and_refs:
+        return shas_and_refs[0][0]
+    return None # abbreviated sha or unknown ref, built without caching
+
+def get_build_artifact_key(irods_sha, icommands_sha, platform_target, debug_build):
+    key_material = json.dumps([irods_sha, icommands_sha, list(platform_target), debug_build])
+    return hashlib.sha256(key_material).hexdigest()
+
+def load_build_artifact_manifest(store_directory, key):
+    try:
+        with open(os.path.join(store_directory, 'manifests', key + '.json')) as f:
+            return json.load(f)
+    except IOError as e:
+        if e.errno != 2:
+            raise
+        return None
+
+def store_build_artifacts(store_directory, manifest, directory):
+    blobs_directory = os.path.join(store_directory, 'blobs')
+    manifests_directory = os.path.join(store_directory, 'manifests')
+    library.makedirs_catch_preexisting(blobs_directory)
+    library.makedirs_catch_preexisting(manifests_directory)
+
+    manifest = dict(manifest)
+    manifest['files'] = {}
+    for basename in sorted(os.listdir(directory)):
+        filename = os.path.join(directory, basename)
+        if not os.path.isfile(filename):
+            continue
+        sha256 = library.sha256_of_file(filename)
+        blob = os.path.join(blobs_directory, sha256)
+        if not os.path.exists(blob):
+            fd, temp_blob = tempfile.mkstemp(prefix='.' + sha256, dir=blobs_directory)
+            os.close(fd)
+            shutil.copy2(filename, temp_blob)
+            os.chmod(temp_blob, 0444)
+            os.rename(temp_blob, blob)
+        manifest['files'][basename] = sha256
+    library.write_file_atomically(os.path.join(manifests_directory, manifest['key'] + '.json'), json.dumps(manifest, indent=4, sort_keys=True))
+
+# outputs are copies, not hardlinks, so later edits in the output directory can't change the store
+def restore_build_artifacts(store_directory, manifest, output_root_directory):
+    output_directory = os.path.join(output_root_directory, manifest['irods_platform_string'])
+    library.makedirs_catch_preexisting(output_directory)
+    for basename, sha256 in manifest['files'].items():
+        blob = os.path.join(store_directory, 'blobs', sha256)
+        destination = os.path.join(output_directory, basename)
+        if os.path.isfile(destination) and library.sha256_of_file(destination) == sha256:
+            continue # restored by an earlier run into the same output directory
+        fd, temp_destination = tempfile.mkstemp(prefix='.' + basename, dir=output_directory)
+        os.close(fd)
+        shutil.copy2(blob, temp_destination)
+        os.chmod(temp_destination, 0644)
+        os.rename(temp_destination, destination)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build iRODS packages, reusing previously built commits')
+    parser.add_argument('--run_name', type=str, required=True)
+    parser.add_argument('--output_root_directory', type=str, required=True)
+    parser.add_argument('--git_repository', type=str, required=True)
+    parser.add_argument('--git_commitish', type=str, required=True)
+    parser.add_argument('--git_repository_icommands', type=str, required=True)
+    parser.add_argument('--git_commitish_icommands', type=str, required=True)
+    parser.add_argument('--debug_build', action='store_true')
+    parser.add_argument('--platform_targets', type=str)
+    parser.add_argument('--leak_vms', action='store_true')
+    args = parser.parse_args()
+
+    platform_targets = None
+    if args.platform_targets:
+        platform_targets = eval(args.platform_targets) # e.g.  platform_targets = [('CentOS', '6'), ('Ubuntu', '14')]
+
+    library.register_log_handlers()
+    library.convert_sigterm_to_exception()
+
+    build(args.run_name, args.output_root_directory, args.git_repository, args.git_commitish, args.git_repository_icommands, args.git_commitish_icommands, args.debug_build, platform_targets, args.leak_vms)
@@ -5,6 +5,7 @@ import library
 
 def run_build_hook_on_vms(build_name, leak_vms, git_repository, git_commitish, python_script, platform_targets, passthrough_arguments):
     platform_targets = eval(platform_targets) # e.g.  platform_targets = [('CentOS', '6'), ('Ubuntu', '12'), ('Ubuntu', '14'), ('openSUSE ', '13')]
+    library.update_git_mirrors([git_repository])
     vm_names, ip_addresses = library.deploy_vms_return_names_and_ips(build_name, platform_targets)
     with library.vm_manager(vm_names, leak_vms=leak_vms):
         build_plugin_on_vms(ip_addresses, git_repository, git_commitish, python_script, passthrough_arguments)
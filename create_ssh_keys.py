@@ -14,11 +14,16 @@ private_ssh_key_path = '/var/lib/irods/.ssh/id_rsa'
 public_ssh_key_path = '/var/lib/irods/.ssh/id_rsa.pub'
 authorized_keys_path = '/var/lib/irods/.ssh/authorized_keys'
 
+# the other zones share the first zone's key so test code can be streamed between ICATs (see test.copy_testing_code)
 def share_ssh_keys(deployed_zone_bundle):
-    zone = deployed_zone_bundle['zones'][0]
-    share_ssh_files_zone(zone)
+    zones = [deployed_zone_bundle['zones'][0]]
+    zones += [zone for zone in deployed_zone_bundle['zones'][1:] if zone['icat_server']['version']['irods_version'] != '3.3.1']
+    share_ssh_files_zones(zones)
 
 def share_ssh_files_zone(zone):
+    share_ssh_files_zones([zone])
+
+def share_ssh_files_zones(zones):
     with tempfile.NamedTemporaryFile(prefix='ssh-keyfile') as f_ssh_keyfile:
         create_ssh_key_files(f_ssh_keyfile.name)
         tmp_public_key = f_ssh_keyfile.name+'.pub'
@@ -26,9 +31,10 @@ def share_ssh_files_zone(zone):
         files_to_copy = [(f_ssh_keyfile.name, private_ssh_key_path, '0600'),
                          (tmp_public_key, public_ssh_key_path, '0644'),
                          (tmp_public_key, authorized_keys_path, '0644')]
-        for src, dst, perms in files_to_copy:
-            print('src: '+src)
-            library.copy_file_to_zone(zone, src, dst, 'irods', 'irods', perms)
+        for zone in zones:
+            for src, dst, perms in files_to_copy:
+                print('src: '+src)
+                library.copy_file_to_zone(zone, src, dst, 'irods', 'irods', perms)
 
 def create_ssh_key_files(filename):
     p = subprocess.Popen(['ssh-keygen', '-N', '', '-f', filename], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -10,6 +10,7 @@ import library
 
 
 def deploy(zone_bundle_input, deployment_name, version_to_packages_map, mungefs_packages_dir, zone_bundle_output_file=None, destroy_vm_on_failure=True, install_dev_package=False):
+    library.update_git_mirrors(library.git_repositories_cloned_during_deployment)
     zone_bundle_deployed = deploy_zone_bundle(zone_bundle_input, deployment_name)
     with destroy.deployed_zone_bundle_manager(zone_bundle_deployed, on_regular_exit=False, on_exception=destroy_vm_on_failure):
         if zone_bundle_output_file:
@@ -145,8 +146,24 @@ def install_irods_on_zone_bundle(zone_bundle, version_to_packages_map, mungefs_p
     return zone_bundle_updated
 
 def install_irods_on_zone(zone, version_to_packages_map, mungefs_packages_dir, install_dev_package):
-    icat_server = install_irods_on_zone_icat_server(zone['icat_server'], version_to_packages_map, mungefs_packages_dir, install_dev_package)
-    resource_servers = install_irods_on_zone_resource_servers(zone['resource_servers'], version_to_packages_map, install_dev_package)
+    resource_servers = zone['resource_servers']
+    proc_pool = None
+    try:
+        if len(resource_servers) > 0:
+            proc_pool = library.RecursiveMultiprocessingPool(len(resource_servers))
+            proc_pool_results = [proc_pool.apply_async(install_irods_on_zone_resource_server,
+                                                       (resource_server, version_to_packages_map, install_dev_package, 'prepare'))
+                                 for resource_server in resource_servers]
+        icat_server = install_irods_on_zone_icat_server(zone['icat_server'], version_to_packages_map, mungefs_packages_dir, install_dev_package)
+        if len(resource_servers) > 0:
+            resource_servers = [result.get() for result in proc_pool_results]
+    finally:
+        # also stops the prepare phase when the icat server install fails
+        if proc_pool is not None:
+            proc_pool.terminate()
+            proc_pool.join()
+    if len(resource_servers) > 0:
+        resource_servers = install_irods_on_zone_resource_servers(resource_servers, version_to_packages_map, install_dev_package, 'join_zone')
     zone['icat_server'] = icat_server
     zone['resource_servers'] = resource_servers
     if len(resource_servers) > 0:
@@ -161,36 +178,58 @@ def install_irods_on_zone_icat_server(icat_server, version_to_packages_map, mung
             'irods_packages_root_directory': version_to_packages_map[icat_server['version']['irods_version']],
             'mungefs_packages_root_directory': mungefs_packages_dir,
             'install_dev_package': install_dev_package,
+            'artifact_cache_root_directory': library.get_artifact_cache_root_directory(),
         }
+        library.push_external_artifacts([icat_ip], get_external_artifacts_for_icat_server(icat_server))
         data = library.run_ansible(module_name='irods_installation_icat_server', complex_args=complex_args, host_list=[icat_ip], sudo=True)
+        cache_setup_irods_configuration(icat_server, data['contacted'][icat_ip])
         if icat_server['version']['irods_version'] == 'deployment-determined':
             icat_server['version']['irods_version'] = '.'.join(map(str, data['contacted'][icat_ip]['irods_version']))
 
     return icat_server
 
-def install_irods_on_zone_resource_servers(resource_servers, version_to_packages_map, install_dev_package):
+def get_external_artifacts_for_icat_server(icat_server):
+    database_type = icat_server['database_config']['catalog_database_type']
+    os_distribution_name = icat_server['host_system_information']['os_distribution_name']
+    os_distribution_version_major = icat_server['host_system_information']['os_distribution_version'].split('.')[0]
+    if database_type == 'oracle':
+        return ['oci.tar']
+    if database_type == 'mysql' and os_distribution_name == 'Ubuntu' and os_distribution_version_major == '16':
+        return ['mysql-connector-odbc-5.3.7-linux-ubuntu16.04-x86-64bit.tar.gz']
+    return []
+
+def install_irods_on_zone_resource_servers(resource_servers, version_to_packages_map, install_dev_package, phase='all'):
     n = len(resource_servers)
     if n > 0:
         proc_pool = library.RecursiveMultiprocessingPool(n)
         proc_pool_results = [proc_pool.apply_async(install_irods_on_zone_resource_server,
-                                                   (resource_server, version_to_packages_map, install_dev_package))
+                                                   (resource_server, version_to_packages_map, install_dev_package, phase))
                              for resource_server in resource_servers]
         resource_servers = [result.get() for result in proc_pool_results]
     return resource_servers
 
-def install_irods_on_zone_resource_server(resource_server, version_to_packages_map, install_dev_package):
+def install_irods_on_zone_resource_server(resource_server, version_to_packages_map, install_dev_package, phase='all'):
     resource_ip = resource_server['deployment_information']['ip_address']
     complex_args = {
         'resource_server': resource_server,
         'irods_packages_root_directory': version_to_packages_map[resource_server['version']['irods_version']],
         'install_dev_package': install_dev_package,
+        'phase': phase,
     }
     data = library.run_ansible(module_name='irods_installation_resource_server', complex_args=complex_args, host_list=[resource_ip], sudo=True)
+    cache_setup_irods_configuration(resource_server, data['contacted'][resource_ip])
 
     if resource_server['version']['irods_version'] == 'deployment-determined':
         resource_server['version']['irods_version'] = '.'.join(map(str, data['contacted'][resource_ip]['irods_version']))
     return resource_server
 
+def cache_setup_irods_configuration(server, installation_result):
+    # kept in the deployed zone bundle so a redeployment from the same inputs reuses the exact same unattended setup input
+    setup_irods_configuration = installation_result.get('setup_irods_configuration')
+    if setup_irods_configuration:
+        server['deployment_information']['setup_irods_configuration'] = setup_irods_configuration
+        server['deployment_information']['setup_irods_configuration_inputs_sha256'] = installation_result.get('setup_irods_configuration_inputs_sha256')
+
 def configure_federation_on_zone_bundle(zone_bundle):
     disable_client_server_negotiation = False
     for zone in zone_bundle['zones']:
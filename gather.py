@@ -1,20 +1,32 @@
 import argparse
+import contextlib
 import json
 import os
+import tarfile
 
+import artifact_store
 import configuration
 import library
 
 
-def gather(zone_bundle, output_root_directory):
+# with a gathered artifact store configured the archives are moved into it as run_name
+# (the output directory's name by default)
+def gather(zone_bundle, output_root_directory, run_name=None):
     gather_zone_bundle(zone_bundle, output_root_directory)
+    if artifact_store.get_gathered_artifact_store_directory():
+        artifact_store.store_gathered_archives(output_root_directory, run_name or os.path.basename(os.path.abspath(output_root_directory)))
 
+# every server of every zone is gathered by the same ansible run, so all hosts are gathered at once
 def gather_zone_bundle(zone_bundle, output_root_directory):
+    servers = []
     for zone in zone_bundle['zones']:
-        gather_zone(zone, output_root_directory)
+        servers.extend(library.get_servers_from_zone(zone))
+    gather_servers(servers, output_root_directory)
 
 def gather_zone(zone, output_root_directory):
-    servers = library.get_servers_from_zone(zone)
+    gather_servers(library.get_servers_from_zone(zone), output_root_directory)
+
+def gather_servers(servers, output_root_directory):
     host_list = [server['deployment_information']['ip_address'] for server in servers]
 
     complex_args = {
@@ -23,10 +35,42 @@ def gather_zone(zone, output_root_directory):
 
     library.run_ansible(module_name='irods_gathering', complex_args=complex_args, host_list=host_list)
 
+# irods_gathering writes output_root_directory/<hostname>.tar.gz and <hostname>.manifest.json,
+# hostname being whatever the server reports, which may be its short name
+def get_gathered_archive(output_root_directory, hostname):
+    for name in [hostname, hostname.split('.')[0]]:
+        archive = os.path.join(output_root_directory, name + '.tar.gz')
+        if os.path.isfile(archive):
+            return archive
+    return None
+
+# yields (path on the server, file object, mtime on the server) for the archived files whose path satisfies predicate
+def iterate_gathered_files(archive, predicate):
+    with contextlib.closing(tarfile.open(archive, 'r:gz')) as t:
+        for member in t:
+            path = '/' + member.name
+            if member.isfile() and predicate(path):
+                yield path, t.extractfile(member), member.mtime
+
+# the gathered files of hostname, from its archive or from the artifact store the archive was moved into
+def iterate_gathered_host_files(output_root_directory, hostname, predicate):
+    archive = get_gathered_archive(output_root_directory, hostname)
+    if archive is not None:
+        return iterate_gathered_files(archive, predicate)
+    try:
+        with open(os.path.join(output_root_directory, 'gathered_artifacts.json')) as f:
+            stored_run = json.load(f)
+    except IOError as e:
+        if e.errno != 2:
+            raise
+        return iter([])
+    return artifact_store.iterate_stored_files(stored_run['store_directory'], stored_run['run_id'], hostname, predicate)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Consolidate iRODS files from Zone')
     parser.add_argument('--zone_bundle_input', type=str, required=True)
     parser.add_argument('--output_root_directory', type=str, required=True)
+    parser.add_argument('--run_name', type=str, help='name of the run in the gathered artifact store, defaults to the output directory name')
     args = parser.parse_args()
 
     with open(args.zone_bundle_input) as f:
@@ -35,4 +79,4 @@ if __name__ == '__main__':
     library.register_log_handlers()
     library.convert_sigterm_to_exception()
 
-    gather(zone_bundle, args.output_root_directory)
+    gather(zone_bundle, args.output_root_directory, args.run_name)
@@ -1,5 +1,7 @@
 import argparse
+import functools
 import json
+import logging
 import os
 import sys
 
@@ -8,7 +10,10 @@ import destroy
 import enable_ssl
 import gather
 import library
+import log_index
 import test
+import test_history
+import test_selection
 import upgrade
 
 
@@ -18,6 +23,35 @@ def list_to_dict(l):
         d[l[i]] = l[i+1]
     return d
 
+def deploy_test_shards(zone_bundle, deployment_name, version_to_packages_map, mungefs_packages_root_dir, output_directory, test_shards):
+    if test_shards == 1:
+        return [deploy.deploy(zone_bundle, deployment_name, version_to_packages_map, mungefs_packages_root_dir, os.path.join(output_directory, 'deployed_zone_bundle.json'))]
+
+    proc_pool = library.RecursiveMultiprocessingPool(test_shards)
+    proc_pool_results = []
+    for i in range(test_shards):
+        shard_deployment_name = deployment_name if i == 0 else '{0}_shard{1}'.format(deployment_name, i)
+        shard_zone_bundle_output = os.path.join(output_directory, 'deployed_zone_bundle.json' if i == 0 else 'deployed_zone_bundle_shard{0}.json'.format(i))
+        proc_pool_results.append(proc_pool.apply_async(deploy.deploy, (zone_bundle, shard_deployment_name, version_to_packages_map, mungefs_packages_root_dir, shard_zone_bundle_output)))
+
+    deployed_zone_bundles = []
+    failures = []
+    for result in proc_pool_results:
+        try:
+            deployed_zone_bundles.append(result.get())
+        except Exception as e:
+            failures.append(e)
+    if failures:
+        for deployed_zone_bundle in deployed_zone_bundles:
+            destroy.destroy(deployed_zone_bundle)
+        raise failures[0]
+    return deployed_zone_bundles
+
+def combine_zone_bundles(zone_bundles):
+    combined_zone_bundle = dict(zone_bundles[0])
+    combined_zone_bundle['zones'] = [zone for zone_bundle in zone_bundles for zone in zone_bundle['zones']]
+    return combined_zone_bundle
+
 if __name__ == '__main__':
     library.register_log_handlers()
     library.convert_sigterm_to_exception()
@@ -30,9 +64,20 @@ if __name__ == '__main__':
     parser.add_argument('--test_type', type=str, required=True, choices=['standalone_icat', 'topology_icat', 'topology_resource', 'federation'])
     parser.add_argument('--use_ssl', action='store_true')
     parser.add_argument('--use_mungefs', action='store_true')
+    parser.add_argument('--concurrent_federation', action='store_true')
+    parser.add_argument('--abort_after_failures', type=int, help='stop the tests, gather, and release the VMs once this many tests have failed')
+    parser.add_argument('--abort_failure_rate', type=float, help='likewise if this fraction of the first --abort_failure_rate_window tests failed')
+    parser.add_argument('--abort_failure_rate_window', type=int, default=50)
+    parser.add_argument('--rerun_failed_tests', type=int, default=0, help='rerun only the failed tests up to this many times on the same deployment')
+    parser.add_argument('--test_partitions', type=int, default=1, help='concurrent partitions of the suite on each test server')
     parser.add_argument('--upgrade_test', nargs='+')
     parser.add_argument('--leak_vms', type=library.make_argparse_true_or_false('--leak_vms'), required=False)
     parser.add_argument('--output_directory', type=str, required=True)
+    parser.add_argument('--test_shards', type=int, default=1, help='number of identical deployments to split the test suite across')
+    parser.add_argument('--irods_git_repository', type=str, default='https://github.com/irods/irods.git')
+    parser.add_argument('--irods_base_commit', type=str, help='with --irods_head_commit, only run the test modules impacted by the changes between them')
+    parser.add_argument('--irods_head_commit', type=str)
+    parser.add_argument('--full_suite_interval_hours', type=float, default=24, help='change-based selection still runs the full suite this often')
     args = parser.parse_args()
 
     version_to_packages_map = list_to_dict(args.version_to_packages_map)
@@ -40,18 +85,38 @@ if __name__ == '__main__':
     with open(args.zone_bundle_input) as f:
         zone_bundle = json.load(f)
 
-    zone_bundle_output = os.path.join(args.output_directory, 'deployed_zone_bundle.json')
- 
-    deployed_zone_bundle = deploy.deploy(zone_bundle, args.deployment_name, version_to_packages_map, args.mungefs_packages_root_dir, zone_bundle_output)
+    library.makedirs_catch_preexisting(args.output_directory)
+    deployed_zone_bundles = deploy_test_shards(zone_bundle, args.deployment_name, version_to_packages_map, args.mungefs_packages_root_dir, args.output_directory, args.test_shards)
+    deployed_zone_bundle = combine_zone_bundles(deployed_zone_bundles)
     with destroy.deployed_zone_bundle_manager(deployed_zone_bundle, on_exception=not args.leak_vms, on_regular_exit=not args.leak_vms):
-        if args.upgrade_test:
-            for pd in args.upgrade_test:
-                upgrade.upgrade(deployed_zone_bundle, pd)
-
-        if args.use_ssl:
-            enable_ssl.enable_ssl(deployed_zone_bundle)
-        tests_passed = test.test(deployed_zone_bundle, args.test_type, args.use_ssl, args.use_mungefs, args.output_directory)
-        gather.gather(deployed_zone_bundle, args.output_directory)
+        for shard_zone_bundle in deployed_zone_bundles:
+            if args.upgrade_test:
+                for pd in args.upgrade_test:
+                    upgrade.upgrade(shard_zone_bundle, pd)
+
+            if args.use_ssl:
+                enable_ssl.enable_ssl(shard_zone_bundle)
+        test_durations = None
+        if args.test_shards > 1 or args.test_partitions > 1:
+            try:
+                test_durations = test_history.get_test_module_durations_for_zone(deployed_zone_bundle['zones'][0])
+            except Exception:
+                logging.getLogger(__name__).exception('failed to read test durations, splitting the tests evenly')
+        select_tests = None
+        if args.irods_base_commit and args.irods_head_commit:
+            select_tests = functools.partial(test_selection.select_tests, git_repository=args.irods_git_repository, base_commit=args.irods_base_commit, head_commit=args.irods_head_commit,
+                                             output_directory=args.output_directory, schedule_key=args.test_type, full_suite_interval_hours=args.full_suite_interval_hours)
+        tests_passed = test.test_sharded(deployed_zone_bundles, args.test_type, args.use_ssl, args.use_mungefs, args.output_directory, test_durations, args.concurrent_federation, select_tests,
+                                         test.get_failure_threshold_from_arguments(args), args.rerun_failed_tests, args.test_partitions)
+        gather.gather(deployed_zone_bundle, args.output_directory, args.deployment_name)
+        try:
+            test_history.record_gathered_test_reports(deployed_zone_bundle, args.output_directory, args.deployment_name)
+        except Exception:
+            logging.getLogger(__name__).exception('failed to record test history')
+        try:
+            log_index.index_gathered_logs(deployed_zone_bundle, args.output_directory, args.deployment_name)
+        except Exception:
+            logging.getLogger(__name__).exception('failed to index the gathered logs')
 
     if not tests_passed:
         sys.exit(1)
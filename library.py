@@ -1,12 +1,16 @@
 import contextlib
+import getpass
 import imp
 import logging
 import multiprocessing
 import multiprocessing.pool
 import os
+import shutil
 import signal
 import sys
+import tempfile
 import time
+import urllib2
 import yaml
 
 import ansible.constants
@@ -16,6 +20,7 @@ import ansible.inventory
 import ansible.runner
 
 import configuration
+import local_ansible_utils_extension
 
 module_tuple = imp.find_module(configuration.provisioner_module_name, [configuration.provisioner_module_import_path])
 imp.load_module('provisioner_lib', *module_tuple)
@@ -36,6 +41,19 @@ class RecursiveMultiprocessingPool(multiprocessing.pool.Pool):
 class IrodsAnsibleException(Exception):
     pass
 
+# name -> source url or path, each artifact's sha256 is pinned in configuration.external_artifact_sha256s
+external_artifact_sources = {
+    'oci.tar': 'http://people.renci.org/~jasonc/irods/oci.tar',
+    'mysql-connector-odbc-5.3.7-linux-ubuntu16.04-x86-64bit.tar.gz': '/projects/irods/vsphere-testing/externals/mysql-connector-odbc-5.3.7-linux-ubuntu16.04-x86-64bit.tar.gz',
+}
+
+remote_external_artifact_directory = local_ansible_utils_extension.external_artifact_directory
+remote_irods_testing_abort_file = local_ansible_utils_extension.irods_testing_abort_file
+sha256_of_file = local_ansible_utils_extension.sha256_of_file
+get_git_mirror_name = local_ansible_utils_extension.get_git_mirror_name
+makedirs_catch_preexisting = local_ansible_utils_extension.makedirs_catch_preexisting
+write_file_atomically = local_ansible_utils_extension.write_file_atomically
+
 def get_servers_from_zone_bundle(zone_bundle):
     servers = []
     for zone in zone_bundle['zones']:
@@ -80,19 +98,92 @@ def vm_manager(vm_names, leak_vms):
         if not leak_vms:
             destroy_build_vms(vm_names)
 
+def get_artifact_cache_root_directory():
+    # optional, must be on storage shared with the VMs (like the packages directories)
+    return getattr(configuration, 'artifact_cache_root_directory', None)
+
+def get_external_artifact_store_directory():
+    root_directory = get_artifact_cache_root_directory() or os.path.expanduser('~/.irods_testing_zone_bundle')
+    return os.path.join(root_directory, 'external_artifacts')
+
+def is_external_artifact_pinned(name):
+    return name in (getattr(configuration, 'external_artifact_sha256s', None) or {})
+
+def get_external_artifact_sha256(name):
+    external_artifact_sha256s = getattr(configuration, 'external_artifact_sha256s', None) or {}
+    if name not in external_artifact_sha256s:
+        raise RuntimeError('no sha256 pinned for external artifact [{0}], add it to external_artifact_sha256s in configuration.py'.format(name))
+    return external_artifact_sha256s[name]
+
+def get_external_source_sha256s():
+    return getattr(configuration, 'external_source_sha256s', None) or {}
+
+def fetch_external_artifact(name):
+    logger = logging.getLogger(__name__)
+    source = external_artifact_sources[name]
+    expected_sha256 = get_external_artifact_sha256(name)
+    store_directory = get_external_artifact_store_directory()
+    makedirs_catch_preexisting(store_directory)
+    artifact = os.path.join(store_directory, name)
+    if os.path.exists(artifact):
+        if sha256_of_file(artifact) == expected_sha256:
+            return artifact, expected_sha256
+        logger.warning('stored artifact [%s] failed checksum verification, fetching it again', artifact)
+
+    fd, temp_artifact = tempfile.mkstemp(prefix='.' + name, dir=store_directory)
+    with os.fdopen(fd, 'wb') as f_out:
+        if '://' in source:
+            f_in = urllib2.urlopen(source)
+        else:
+            f_in = open(source, 'rb')
+        try:
+            shutil.copyfileobj(f_in, f_out)
+        finally:
+            f_in.close()
+    sha256 = sha256_of_file(temp_artifact)
+    if sha256 != expected_sha256:
+        os.unlink(temp_artifact)
+        raise RuntimeError('artifact [{0}] from [{1}] has sha256 [{2}], expected [{3}]'.format(name, source, sha256, expected_sha256))
+    os.rename(temp_artifact, artifact)
+    logger.info('stored artifact [%s] from [%s] with sha256 [%s]', name, source, sha256)
+    return artifact, sha256
+
+def push_external_artifacts(host_list, names):
+    if not names:
+        return
+    run_ansible(module_name='file', complex_args={'path': remote_external_artifact_directory, 'state': 'directory'}, host_list=host_list, sudo=True)
+    for name in names:
+        artifact, sha256 = fetch_external_artifact(name)
+        remote_artifact = os.path.join(remote_external_artifact_directory, name)
+        run_ansible(module_name='copy', complex_args={'src': artifact, 'dest': remote_artifact}, host_list=host_list, sudo=True)
+        run_ansible(module_name='copy', complex_args={'content': sha256, 'dest': remote_artifact + '.sha256'}, host_list=host_list, sudo=True)
+
+# repositories cloned by the installation modules themselves
+git_repositories_cloned_during_deployment = [
+    'https://github.com/pypa/pip.git',
+    'https://github.com/mysqludf/lib_mysqludf_preg.git',
+]
+
+def get_git_mirror_root_directory():
+    artifact_cache_root_directory = get_artifact_cache_root_directory()
+    if not artifact_cache_root_directory:
+        return None
+    return os.path.join(artifact_cache_root_directory, 'git_mirrors')
+
+def update_git_mirrors(repositories):
+    git_mirror_root_directory = get_git_mirror_root_directory()
+    if not git_mirror_root_directory:
+        return
+    makedirs_catch_preexisting(git_mirror_root_directory)
+    for repository in sorted(set(repositories)):
+        local_ansible_utils_extension.update_git_mirror(git_mirror_root_directory, repository)
+
 def get_ansible_modules_directory():
     return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ansible_modules')
 
 def format_ansible_output(ansible_dict):
     return yaml.safe_dump(ansible_dict, default_flow_style=False)
 
-def makedirs_catch_preexisting(*args, **kwargs):
-    try:
-        os.makedirs(*args, **kwargs)
-    except OSError as e:
-        if e[0] != 17: # 17 == File exists
-            raise
-
 def ansible_run_failed(ansible_results):
     if len(ansible_results['dark']) > 0:
         return True
@@ -116,11 +207,14 @@ def copy_file_to_zone(zone, file_src, file_dest, file_owner, file_group, file_mo
     data = run_ansible(host_list=host_list, module_name='copy', complex_args=complex_args, sudo=True)
     return data
 
-def run_ansible(host_list, additional_modules_directories=[], **kwargs):
+def run_ansible(host_list, additional_modules_directories=[], log_output=True, **kwargs):
     logger = logging.getLogger(__name__)
     inventory = ansible.inventory.Inventory(host_list)
     num_targets = len(host_list)
     module_path = os.pathsep.join([get_ansible_modules_directory()]+additional_modules_directories)
+    git_mirror_root_directory = get_git_mirror_root_directory()
+    if git_mirror_root_directory:
+        kwargs['environment'] = dict(kwargs.get('environment') or {}, IRODS_GIT_MIRROR_ROOT_DIRECTORY=git_mirror_root_directory)
     r = ansible.runner.Runner(
         forks=num_targets,
         module_path=module_path,
@@ -134,9 +228,19 @@ def run_ansible(host_list, additional_modules_directories=[], **kwargs):
     if ansible_run_failed(data):
         logger.error(format_ansible_output(data))
         raise IrodsAnsibleException('ansible failed')
-    logger.info(format_ansible_output(data))
+    if log_output:
+        logger.info(format_ansible_output(data))
     return data
 
+# returns host -> async job id, see get_ansible_async_job_file()
+def run_ansible_in_background(host_list, timeout_seconds, additional_modules_directories=[], **kwargs):
+    data = run_ansible(host_list, additional_modules_directories, background=timeout_seconds, **kwargs)
+    return dict((host, result['ansible_job_id']) for host, result in data['contacted'].items())
+
+# where a background job started without sudo leaves its status on the remote host, as async_status reads it
+def get_ansible_async_job_file(job_id):
+    return '~{0}/.ansible_async/{1}'.format(configuration.remote_user or getpass.getuser(), job_id)
+
 def register_log_handlers():
     logging.Formatter.converter = time.gmtime
     logger_root = logging.getLogger()
@@ -20,19 +20,92 @@
 #  install_os_packages_from_files(files)
 #   files is a list of strings of filenames (e.g. ["irods-icat-4.1.4-64bit-centos6.rpm"]
 #
+#  update_git_mirror(git_mirror_root_directory, repository) -> string
+#   creates or fetches repository's bare mirror in git_mirror_root_directory, returns its path
+#
+#  git_clone(repository, commitish=None, local_dir=None, shallow=False) -> string
+#   clones from the controller's mirror when IRODS_GIT_MIRROR_ROOT_DIRECTORY holds one for repository,
+#   otherwise from the network (shallowly for branches and tags when shallow is set)
+#
+#  install_irods_repository(local_repository_directory=None)
+#   adds the core-dev package repository, plus the local one (see publish_to_local_package_repository)
+#   at the default priority when local_repository_directory holds one, so the newest version wins
+#   whichever repository has it
+#
+#  get_local_package_repository_directory(artifact_cache_root_directory) -> string or None
+#   this platform's package repository in the shared cache, None when caching is disabled
+#
+#  publish_to_local_package_repository(files, repository_directory)
+#   copies packages into repository_directory and regenerates its apt/yum/zypper metadata
+#
 #  get_irods_version() -> three-tuple of ints (e.g. (4, 1, 5))
 #   throws RuntimeError if no irods version files present
 #
+#  get_irods_test_output_file() -> string
+#   where irods_testing collects run_tests.py's output
+#
+#  get_test_runner_directory() -> string
+#   directory holding run_tests.py, throws RuntimeError if there is none
+#
+#  irods_setup_script_supports_json_configuration() -> bool
+#   True if setup_irods.py can be run unattended from a JSON file (4.2+)
+#
+#  load_irods_packaging_template(filename) -> dict
+#   contents of a JSON template from /var/lib/irods/packaging
+#
+#  generate_irods_setup_configuration(zone_bundle_server_config, catalog_service_role, catalog_provider_host,
+#                                     default_resource_name, admin_password, database_configuration=None) -> dict
+#   unattended setup_irods.py input built from the packaging templates and the zone bundle
+#
+#  get_irods_setup_configuration(deployment_information, *args, **kwargs) -> (dict, string)
+#   the setup configuration cached in deployment_information when it was generated from the same irods version
+#   and generate_irods_setup_configuration() arguments, a freshly generated one otherwise, along with its inputs' sha256
+#
+#  run_irods_setup_script_with_json_configuration(setup_configuration, output_log)
+#   runs setup_irods.py non-interactively, teeing its output to output_log
+#
+#  get_artifact_cache_directory(artifact_cache_root_directory, *path_components) -> string or None
+#   per-artifact directory in the shared cache, None when caching is disabled
+#
+#  publish_to_artifact_cache(files, cache_directory)
+#   atomically populates cache_directory with copies of files, first writer wins
+#
+#  fetch_artifact(name) -> string
+#   path to the copy of an external artifact the controller pushed and verified against its pinned sha256
+#   (see library.push_external_artifacts), throws RuntimeError if it is missing or damaged
+#
+#  fetch_and_extract_artifact(name) -> string
+#   directory the fetched tar archive was extracted into
+#
+#  fetch_oracle_instant_client_packages() -> string
+#   directory holding the Oracle instant client packages from oci.tar
+#
+#  makedirs_catch_preexisting(*args, **kwargs)
+#   os.makedirs that tolerates the directory already existing
+#
+#  write_file_atomically(filename, contents)
+#   readers of filename see either its old or its new contents, never a partial write
+#
+#  get_build_parallelism(memory_per_job_in_gigabytes=2) -> int
+#   number of make jobs this machine's CPUs and available memory can sustain
+#
 # Provides the following context managers:
 #
 #  euid_and_egid_set(name)
 #   sets euid and egid to that corresponding to name (per pwd)
 
 import contextlib
+import errno
+import fcntl
+import hashlib
 import json
+import multiprocessing
 import os
 import platform
 import pwd
+import re
+import shutil
+import socket
 import subprocess
 import tempfile
 
@@ -68,7 +141,7 @@ def install_pip():
     if platform.linux_distribution()[0] == 'Ubuntu':
         install_os_packages(['python-setuptools'])
     local_pip_git_dir = tempfile.mkdtemp(prefix='pip_git_dir')
-    git_clone('https://github.com/pypa/pip.git', '7.1.2', local_pip_git_dir)
+    git_clone('https://github.com/pypa/pip.git', '7.1.2', local_pip_git_dir, shallow=True)
     subprocess_get_output(['sudo', '-E', 'python', 'setup.py', 'install'], cwd=local_pip_git_dir, check_rc=True)
 
 def pip_install_irods_python_ci_utilities():
@@ -140,18 +213,68 @@ def install_irods_repository_zypper():
     subprocess_get_output(['sudo', 'rpm', '--import', 'https://core-dev.irods.org/irods-core-dev-signing-key.asc'], check_rc=True)
     subprocess_get_output('wget -qO - https://core-dev.irods.org/renci-irods-core-dev.zypp.repo | sudo tee /etc/zypp/repos.d/renci-irods-core-dev.zypp.repo', shell=True, check_rc=True)
 
-def install_irods_repository():
+def install_local_package_repository_apt(repository_directory):
+    subprocess_get_output('echo "deb [trusted=yes] file://{0} ./" | sudo tee /etc/apt/sources.list.d/irods-local.list'.format(repository_directory), shell=True, check_rc=True)
+
+def install_local_package_repository_yum(repository_directory):
+    subprocess_get_output('printf "[irods-local]\\nname=irods-local\\nbaseurl=file://{0}\\ngpgcheck=0\\nmetadata_expire=0\\n" | sudo tee /etc/yum.repos.d/irods-local.repo'.format(repository_directory), shell=True, check_rc=True)
+
+def install_local_package_repository_zypper(repository_directory):
+    subprocess_get_output(['sudo', 'zypper', '--non-interactive', 'removerepo', 'irods-local'])
+    subprocess_get_output(['sudo', 'zypper', '--non-interactive', 'addrepo', '--no-gpgcheck', '--refresh', 'file://' + repository_directory, 'irods-local'], check_rc=True)
+
+def install_irods_repository(local_repository_directory=None):
     dispatch_map = {
-        'Ubuntu': install_irods_repository_apt,
-        'Centos': install_irods_repository_yum,
-        'Centos linux': install_irods_repository_yum,
-        'Opensuse ': install_irods_repository_zypper,
+        'Ubuntu': (install_irods_repository_apt, install_local_package_repository_apt),
+        'Centos': (install_irods_repository_yum, install_local_package_repository_yum),
+        'Centos linux': (install_irods_repository_yum, install_local_package_repository_yum),
+        'Opensuse ': (install_irods_repository_zypper, install_local_package_repository_zypper),
     }
 
     try:
-        dispatch_map[get_distribution()]()
+        install_remote, install_local = dispatch_map[get_distribution()]
     except KeyError:
         raise NotImplementedError('install_irods_repository() for [{0}]'.format(get_distribution()))
+    install_remote()
+    if local_repository_directory and os.path.isdir(local_repository_directory):
+        install_local(local_repository_directory)
+
+def get_local_package_repository_directory(artifact_cache_root_directory):
+    return get_artifact_cache_directory(artifact_cache_root_directory, 'package_repository', get_irods_platform_string())
+
+def generate_local_package_repository_metadata_apt(repository_directory):
+    install_os_packages(['dpkg-dev'])
+    subprocess_get_output('dpkg-scanpackages . /dev/null > Packages.tmp && gzip -9c Packages.tmp > Packages.gz.tmp && mv Packages.tmp Packages && mv Packages.gz.tmp Packages.gz', cwd=repository_directory, shell=True, check_rc=True)
+
+def generate_local_package_repository_metadata_rpm(repository_directory):
+    install_os_packages(['createrepo'])
+    subprocess_get_output(['createrepo', '--update', '.'], cwd=repository_directory, check_rc=True)
+
+def publish_to_local_package_repository(files, repository_directory):
+    dispatch_map = {
+        'Ubuntu': generate_local_package_repository_metadata_apt,
+        'Centos': generate_local_package_repository_metadata_rpm,
+        'Centos linux': generate_local_package_repository_metadata_rpm,
+        'Opensuse ': generate_local_package_repository_metadata_rpm,
+    }
+
+    try:
+        generate_metadata = dispatch_map[get_distribution()]
+    except KeyError:
+        raise NotImplementedError('publish_to_local_package_repository() for [{0}]'.format(get_distribution()))
+    try:
+        os.makedirs(repository_directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    # builders of the same platform publish concurrently
+    with open(os.path.join(repository_directory, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        for f in files:
+            staged = os.path.join(repository_directory, '.' + os.path.basename(f))
+            shutil.copy2(f, staged)
+            os.rename(staged, os.path.join(repository_directory, os.path.basename(f)))
+        generate_metadata(repository_directory)
 
 def get_package_suffix():
     d = get_distribution()
@@ -199,6 +322,191 @@ def get_irods_version_from_bash():
             raise
         return None
 
+# irods_testing stops starting run_tests.py invocations once this exists, must match remote_irods_testing_abort_file in library
+irods_testing_abort_file = '/var/tmp/irods_testing.abort'
+
+def get_irods_test_output_file():
+    if get_irods_version() < (4, 2):
+        return '/var/lib/irods/tests/test_output.txt'
+    return '/var/lib/irods/test/test_output.txt'
+
+def get_test_runner_directory():
+    test_directories = ['/var/lib/irods/scripts',
+                        '/var/lib/irods/tests/pydevtest',]
+    for l in test_directories:
+        if os.path.exists(os.path.join(l, 'run_tests.py')):
+            return l
+
+    raise RuntimeError('failed to find run_tests.py')
+
+def irods_setup_script_supports_json_configuration():
+    setup_script = '/var/lib/irods/scripts/setup_irods.py'
+    if not os.path.exists(setup_script) or get_irods_version()[0:2] < (4, 2):
+        return False
+    if not os.path.exists('/var/lib/irods/packaging/server_config.json.template'):
+        return False
+    with open(setup_script) as f:
+        return 'json_configuration_file' in f.read()
+
+def load_irods_packaging_template(filename, default=None):
+    try:
+        with open(os.path.join('/var/lib/irods/packaging', filename)) as f:
+            return json.load(f)
+    except IOError as e:
+        if e.errno != 2 or default is None:
+            raise
+        return default
+
+def generate_irods_setup_configuration(zone_bundle_server_config, catalog_service_role, catalog_provider_host, default_resource_name, admin_password, database_configuration=None):
+    server_config = load_irods_packaging_template('server_config.json.template')
+    for key, value in zone_bundle_server_config.items():
+        # federation entries are rewritten by apply_zone_bundle() once setup has run
+        if key in server_config and key != 'federation':
+            server_config[key] = value
+    server_config['catalog_service_role'] = catalog_service_role
+    server_config['catalog_provider_hosts'] = [catalog_provider_host]
+    if database_configuration is not None:
+        server_config.setdefault('plugin_configuration', {})['database'] = database_configuration
+
+    zone_name = server_config['zone_name']
+    admin_home = '/{0}/home/{1}'.format(zone_name, server_config['zone_user'])
+    service_account_environment = {
+        'irods_client_server_negotiation': 'request_server_negotiation',
+        'irods_client_server_policy': 'CS_NEG_REFUSE',
+        'irods_connection_pool_refresh_time_in_seconds': 300,
+        'irods_cwd': admin_home,
+        'irods_default_hash_scheme': server_config.get('default_hash_scheme', 'SHA256'),
+        'irods_default_number_of_transfer_threads': 4,
+        'irods_default_resource': default_resource_name,
+        'irods_encryption_algorithm': 'AES-256-CBC',
+        'irods_encryption_key_size': 32,
+        'irods_encryption_num_hash_rounds': 16,
+        'irods_encryption_salt_size': 8,
+        'irods_home': admin_home,
+        'irods_host': socket.getfqdn(),
+        'irods_match_hash_policy': server_config.get('match_hash_policy', 'compatible'),
+        'irods_maximum_size_for_single_buffer_in_megabytes': 32,
+        'irods_port': server_config['zone_port'],
+        'irods_server_control_plane_encryption_algorithm': server_config.get('server_control_plane_encryption_algorithm', 'AES-256-CBC'),
+        'irods_server_control_plane_encryption_num_hash_rounds': server_config.get('server_control_plane_encryption_num_hash_rounds', 16),
+        'irods_server_control_plane_key': server_config['server_control_plane_key'],
+        'irods_server_control_plane_port': server_config['server_control_plane_port'],
+        'irods_transfer_buffer_size_for_parallel_transfer_in_megabytes': 4,
+        'irods_user_name': server_config['zone_user'],
+        'irods_zone_name': zone_name,
+        'schema_name': 'service_account_environment',
+        'schema_version': server_config.get('schema_version', 'v3'),
+    }
+
+    return {
+        'admin_password': admin_password,
+        'default_resource_directory': '/var/lib/irods/Vault',
+        'default_resource_name': default_resource_name,
+        'host_access_control_config': load_irods_packaging_template('host_access_control_config.json.template', {'access_entries': []}),
+        'host_system_information': {
+            'service_account_user_name': 'irods',
+            'service_account_group_name': 'irods',
+        },
+        'hosts_config': load_irods_packaging_template('hosts_config.json.template', {'host_entries': []}),
+        'server_config': server_config,
+        'service_account_environment': service_account_environment,
+    }
+
+def get_irods_setup_configuration(deployment_information, *args, **kwargs):
+    inputs_sha256 = hashlib.sha256(json.dumps([get_irods_version(), args, kwargs], sort_keys=True)).hexdigest()
+    setup_configuration = deployment_information.get('setup_irods_configuration')
+    if setup_configuration is None or deployment_information.get('setup_irods_configuration_inputs_sha256') != inputs_sha256:
+        setup_configuration = generate_irods_setup_configuration(*args, **kwargs)
+    return setup_configuration, inputs_sha256
+
+def run_irods_setup_script_with_json_configuration(setup_configuration, output_log):
+    with tempfile.NamedTemporaryFile(prefix='setup_irods_configuration', suffix='.json') as f:
+        json.dump(setup_configuration, f, indent=4, sort_keys=True)
+        f.flush()
+        subprocess_get_output(['sudo', 'su', '-c', 'python /var/lib/irods/scripts/setup_irods.py --json_configuration_file={0} 2>&1 | tee {1}; exit $PIPESTATUS'.format(f.name, output_log)], check_rc=True)
+
+def makedirs_catch_preexisting(*args, **kwargs):
+    try:
+        os.makedirs(*args, **kwargs)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def write_file_atomically(filename, contents):
+    fd, temp_filename = tempfile.mkstemp(prefix='.' + os.path.basename(filename), dir=os.path.dirname(filename))
+    with os.fdopen(fd, 'w') as f:
+        f.write(contents)
+    os.rename(temp_filename, filename)
+
+def get_artifact_cache_directory(artifact_cache_root_directory, *path_components):
+    if not artifact_cache_root_directory:
+        return None
+    return os.path.join(artifact_cache_root_directory, *path_components)
+
+def publish_to_artifact_cache(files, cache_directory):
+    parent_directory = os.path.dirname(cache_directory)
+    try:
+        os.makedirs(parent_directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    staging_directory = tempfile.mkdtemp(prefix='.' + os.path.basename(cache_directory), dir=parent_directory)
+    try:
+        for f in files:
+            shutil.copy2(f, staging_directory)
+        os.chmod(staging_directory, 0o755)
+        os.rename(staging_directory, cache_directory)
+    except OSError as e:
+        if e.errno not in [errno.EEXIST, errno.ENOTEMPTY]:
+            raise
+    finally:
+        if os.path.exists(staging_directory):
+            shutil.rmtree(staging_directory)
+
+def get_available_memory_in_kilobytes():
+    meminfo = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            meminfo[key] = int(value.split()[0])
+    if 'MemAvailable' in meminfo:
+        return meminfo['MemAvailable']
+    return meminfo['MemFree'] + meminfo.get('Buffers', 0) + meminfo.get('Cached', 0)
+
+def get_build_parallelism(memory_per_job_in_gigabytes=2):
+    jobs_by_memory = get_available_memory_in_kilobytes() // (memory_per_job_in_gigabytes * 1024 * 1024)
+    return max(1, min(multiprocessing.cpu_count(), jobs_by_memory))
+
+external_artifact_directory = '/var/cache/irods_testing_zone_bundle/artifacts'
+
+def sha256_of_file(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def fetch_artifact(name):
+    staged_artifact = os.path.join(external_artifact_directory, name)
+    try:
+        with open(staged_artifact + '.sha256') as f:
+            expected_sha256 = f.read().strip()
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        raise RuntimeError('external artifact [{0}] was not pushed by the controller'.format(name))
+    if sha256_of_file(staged_artifact) != expected_sha256:
+        raise RuntimeError('external artifact [{0}] does not match its sha256 [{1}]'.format(name, expected_sha256))
+    return staged_artifact
+
+def fetch_and_extract_artifact(name):
+    extraction_directory = tempfile.mkdtemp(prefix='artifact_extraction')
+    subprocess_get_output(['tar', '-xf', fetch_artifact(name), '-C', extraction_directory], check_rc=True)
+    return extraction_directory
+
+def fetch_oracle_instant_client_packages():
+    return fetch_and_extract_artifact('oci.tar')
+
 @contextlib.contextmanager
 def euid_and_egid_set(name):
     initial_euid = os.geteuid()
@@ -214,11 +522,61 @@ def euid_and_egid_set(name):
         os.seteuid(initial_euid)
         os.setegid(initial_egid)
 
-def git_clone(repository, commitish=None, local_dir=None):
+def get_git_mirror_name(repository):
+    return re.sub('[^A-Za-z0-9.-]', '_', repository.split('://')[-1]) + '.git'
+
+def update_git_mirror(git_mirror_root_directory, repository):
+    git_mirror = os.path.join(git_mirror_root_directory, get_git_mirror_name(repository))
+    if os.path.exists(git_mirror):
+        subprocess_get_output(['git', '--git-dir', git_mirror, 'fetch', '--prune', '--quiet', 'origin'], check_rc=True)
+        return git_mirror
+    temp_git_mirror = tempfile.mkdtemp(prefix='.' + os.path.basename(git_mirror), dir=git_mirror_root_directory)
+    try:
+        subprocess_get_output(['git', 'clone', '--mirror', '--quiet', repository, temp_git_mirror], check_rc=True)
+        os.rename(temp_git_mirror, git_mirror)
+    except OSError as e:
+        if e.errno not in [errno.EEXIST, errno.ENOTEMPTY]: # mirrored concurrently by another run
+            raise
+    finally:
+        if os.path.exists(temp_git_mirror):
+            shutil.rmtree(temp_git_mirror)
+    return git_mirror
+
+# mirrors are found by the origin url they were cloned from, whatever their directory is named
+def get_git_mirror(repository):
+    git_mirror_root_directory = os.environ.get('IRODS_GIT_MIRROR_ROOT_DIRECTORY')
+    if not git_mirror_root_directory or not os.path.isdir(git_mirror_root_directory):
+        return None
+    for basename in sorted(os.listdir(git_mirror_root_directory)):
+        git_mirror = os.path.join(git_mirror_root_directory, basename)
+        if basename.startswith('.') or not os.path.isfile(os.path.join(git_mirror, 'config')):
+            continue # a mirror still being cloned
+        rc, out, _ = subprocess_get_output(['git', 'config', '--file', os.path.join(git_mirror, 'config'), 'remote.origin.url'])
+        if rc == 0 and out.strip() == repository:
+            return git_mirror
+    return None
+
+def git_clone(repository, commitish=None, local_dir=None, shallow=False):
     if local_dir is None:
         local_dir = tempfile.mkdtemp()
-    subprocess_get_output(['git', 'clone', '--recursive', repository, local_dir], check_rc=True)
+    git_mirror = get_git_mirror(repository)
+    if git_mirror is not None:
+        # a plain local clone of the controller's mirror works with every platform's git, unlike --dissociate
+        subprocess_get_output(['git', 'clone', git_mirror, local_dir], check_rc=True)
+        subprocess_get_output(['git', 'remote', 'set-url', 'origin', repository], cwd=local_dir, check_rc=True)
+    elif shallow and commitish is not None:
+        rc, _, _ = subprocess_get_output(['git', 'clone', '--recursive', '--depth', '1', '--branch', commitish, repository, local_dir])
+        if rc == 0:
+            return local_dir
+        shutil.rmtree(local_dir) # commitish is not a branch or tag
+        subprocess_get_output(['git', 'clone', repository, local_dir], check_rc=True)
+    else:
+        subprocess_get_output(['git', 'clone', repository, local_dir], check_rc=True)
     if commitish is not None:
-        subprocess_get_output(['git', 'checkout', commitish], cwd=local_dir, check_rc=True)
+        rc, _, _ = subprocess_get_output(['git', 'checkout', commitish], cwd=local_dir)
+        if rc != 0: # mirror predates commitish
+            subprocess_get_output(['git', 'fetch', '--tags', 'origin'], cwd=local_dir, check_rc=True)
+            subprocess_get_output(['git', 'fetch', 'origin'], cwd=local_dir, check_rc=True)
+            subprocess_get_output(['git', 'checkout', commitish], cwd=local_dir, check_rc=True)
     subprocess_get_output(['git', 'submodule', 'update', '--init', '--recursive'], cwd=local_dir, check_rc=True)
     return local_dir
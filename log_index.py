@@ -0,0 +1,247 @@
+import argparse
+import calendar
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+
+import configuration
+import gather
+import library
+import test_history
+
+
+def get_log_index_database_file():
+    # optional, a local path (sqlite locking is unreliable on network filesystems)
+    database_file = getattr(configuration, 'log_index_database_file', None)
+    return database_file or os.path.expanduser('~/.irods_testing_zone_bundle/log_index.sqlite')
+
+# Identical files (VERSION, .ini, unchanged logs) are tokenised once, under their content's digest.
+# occurrences counts every line a token is on; postings keeps the first few line numbers for triage.
+def open_log_index_database(database_file=None):
+    if database_file is None:
+        database_file = get_log_index_database_file()
+    library.makedirs_catch_preexisting(os.path.dirname(os.path.abspath(database_file)))
+    connection = sqlite3.connect(database_file, timeout=60)
+    connection.executescript('''
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            run_name TEXT NOT NULL,
+            hostname TEXT NOT NULL,
+            platform TEXT,
+            database_type TEXT,
+            irods_version TEXT,
+            indexed_at REAL NOT NULL,
+            UNIQUE (run_name, hostname)
+        );
+        CREATE TABLE IF NOT EXISTS contents (
+            id INTEGER PRIMARY KEY,
+            sha256 TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            run_id INTEGER NOT NULL REFERENCES runs(id),
+            path TEXT NOT NULL,
+            content_id INTEGER NOT NULL REFERENCES contents(id)
+        );
+        CREATE TABLE IF NOT EXISTS tokens (
+            id INTEGER PRIMARY KEY,
+            token TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS occurrences (
+            token_id INTEGER NOT NULL REFERENCES tokens(id),
+            content_id INTEGER NOT NULL REFERENCES contents(id),
+            count INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS postings (
+            token_id INTEGER NOT NULL REFERENCES tokens(id),
+            content_id INTEGER NOT NULL REFERENCES contents(id),
+            line_number INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS files_by_content ON files (content_id);
+        CREATE INDEX IF NOT EXISTS occurrences_by_token ON occurrences (token_id);
+        CREATE INDEX IF NOT EXISTS postings_by_token_and_content ON postings (token_id, content_id);
+    ''')
+    return connection
+
+error_code_pattern = re.compile(r'\b(?:SYS|CAT|USER|RE|PLUGIN|HIERARCHY|SSL|PAM|KRB|GSI|AUTH|OBJPATH|CHKSUM|UNIX_FILE|INVALID|DIRECT_ARCHIVE)_[A-Z0-9_]*[A-Z0-9]\b')
+error_number_pattern = re.compile(r'(?<![\w.])-[1-9]\d{5,6}\b') # e.g. status -808000
+test_name_pattern = re.compile(r'\b(?:test|Test)_\w+')
+iso_timestamp_pattern = re.compile(r'\b(\d{4})-(\d{2})-(\d{2})[T ]\d{2}:\d{2}')
+rodslog_timestamp_pattern = re.compile(r'^(?:\w{3} )?(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) +(\d{1,2}) \d{2}:\d{2}:\d{2}')
+month_numbers = dict((name, number) for number, name in enumerate(calendar.month_abbr) if name)
+
+# timestamps become day tokens ("date:2016-03-01"); rodsLog omits the year, which is taken from
+# last_modified, the file's mtime as a struct_time, or the year before for months after it
+def tokenise_line(line, hostnames, last_modified):
+    tokens = set(error_code_pattern.findall(line))
+    tokens.update(error_number_pattern.findall(line))
+    tokens.update(test_name_pattern.findall(line))
+    tokens.update(hostname for hostname in hostnames if hostname in line)
+    match = iso_timestamp_pattern.search(line)
+    if match:
+        tokens.add('date:{0}-{1}-{2}'.format(*match.groups()))
+    else:
+        match = rodslog_timestamp_pattern.match(line)
+        if match:
+            month = month_numbers[match.group(1)]
+            year = last_modified.tm_year - 1 if month > last_modified.tm_mon else last_modified.tm_year
+            tokens.add('date:{0}-{1:02d}-{2:02d}'.format(year, month, int(match.group(2))))
+    return tokens
+
+def is_log_file(path):
+    basename = os.path.basename(path)
+    return basename.startswith('rodsLog') or basename.startswith('reLog') or os.path.splitext(basename)[1] in ['.log', '.txt', '.output']
+
+def get_token_id(connection, token, token_ids):
+    if token not in token_ids:
+        connection.execute('INSERT OR IGNORE INTO tokens (token) VALUES (?)', (token,))
+        token_ids[token] = connection.execute('SELECT id FROM tokens WHERE token = ?', (token,)).fetchone()[0]
+    return token_ids[token]
+
+# returns the content id, tokenising the file unless identical content was indexed before
+def index_file(connection, fileobj, mtime, hostnames, token_ids, max_postings_per_token=20):
+    last_modified = time.localtime(mtime)
+    h = hashlib.sha256()
+    line_numbers = {}
+    counts = {}
+    for line_number, line in enumerate(fileobj, 1):
+        h.update(line)
+        for token in tokenise_line(line, hostnames, last_modified):
+            counts[token] = counts.get(token, 0) + 1
+            if counts[token] <= max_postings_per_token:
+                line_numbers.setdefault(token, []).append(line_number)
+
+    sha256 = h.hexdigest()
+    row = connection.execute('SELECT id FROM contents WHERE sha256 = ?', (sha256,)).fetchone()
+    if row:
+        return row[0]
+    content_id = connection.execute('INSERT INTO contents (sha256) VALUES (?)', (sha256,)).lastrowid
+    for token, count in counts.items():
+        token_id = get_token_id(connection, token, token_ids)
+        connection.execute('INSERT INTO occurrences (token_id, content_id, count) VALUES (?, ?, ?)', (token_id, content_id, count))
+        connection.executemany('INSERT INTO postings (token_id, content_id, line_number) VALUES (?, ?, ?)',
+                               [(token_id, content_id, line_number) for line_number in line_numbers[token]])
+    return content_id
+
+# Indexes each server's gathered logs plus the test output irods_testing left in output_root_directory/<hostname>.
+# Runs already indexed under run_name are skipped, so this can be rerun over old output directories.
+def index_gathered_logs(zone_bundle, output_root_directory, run_name, database_file=None):
+    logger = logging.getLogger(__name__)
+    connection = open_log_index_database(database_file)
+    token_ids = {}
+    try:
+        servers_and_zones = [(server, zone) for zone in zone_bundle['zones'] for server in library.get_servers_from_zone(zone)]
+        hostnames = set()
+        for server, _ in servers_and_zones:
+            hostnames.update([server['hostname'], server['hostname'].split('.')[0], server['deployment_information']['ip_address']])
+        for server, zone in servers_and_zones:
+            if connection.execute('SELECT 1 FROM runs WHERE run_name = ? AND hostname = ?', (run_name, server['hostname'])).fetchone():
+                continue
+            file_count = 0
+            with connection:
+                run_id = connection.execute('INSERT INTO runs (run_name, hostname, platform, database_type, irods_version, indexed_at) VALUES (?, ?, ?, ?, ?, ?)',
+                                            (run_name, server['hostname'], test_history.get_server_platform(server), test_history.get_zone_database_type(zone),
+                                             server['version']['irods_version'], time.time())).lastrowid
+                for path, fileobj, mtime in iterate_host_logs(output_root_directory, server['hostname']):
+                    content_id = index_file(connection, fileobj, mtime, hostnames, token_ids)
+                    connection.execute('INSERT INTO files (run_id, path, content_id) VALUES (?, ?, ?)', (run_id, path, content_id))
+                    file_count += 1
+            logger.info('indexed %d log files from %s', file_count, server['hostname'])
+    finally:
+        connection.close()
+
+def iterate_host_logs(output_root_directory, hostname):
+    for path, fileobj, mtime in gather.iterate_gathered_host_files(output_root_directory, hostname, is_log_file):
+        yield path, fileobj, mtime
+    for name in [hostname, hostname.split('.')[0]]:
+        test_output_directory = os.path.join(output_root_directory, name)
+        if os.path.isdir(test_output_directory):
+            for basename in sorted(os.listdir(test_output_directory)):
+                filename = os.path.join(test_output_directory, basename)
+                if os.path.isfile(filename) and is_log_file(filename):
+                    with open(filename) as f:
+                        yield os.path.join('output', basename), f, os.path.getmtime(filename)
+            break
+
+def get_run_filter(platform, database_type, since_days):
+    clauses = []
+    parameters = []
+    if platform is not None:
+        clauses.append('runs.platform = ?')
+        parameters.append(platform)
+    if database_type is not None:
+        clauses.append('runs.database_type = ?')
+        parameters.append(database_type)
+    if since_days is not None:
+        clauses.append('runs.indexed_at >= ?')
+        parameters.append(time.time() - since_days * 24 * 60 * 60)
+    return ' AND '.join(clauses) or '1', parameters
+
+# runs (per host) with every one of tokens in their logs, newest first, with how often each token occurred
+def find_runs(connection, tokens, platform=None, database_type=None, since_days=None):
+    run_filter, parameters = get_run_filter(platform, database_type, since_days)
+    runs = None
+    for token in tokens:
+        rows = connection.execute('''
+            SELECT runs.id, runs.run_name, runs.hostname, runs.platform, runs.database_type, runs.indexed_at, SUM(occurrences.count)
+            FROM tokens
+            JOIN occurrences ON occurrences.token_id = tokens.id
+            JOIN files ON files.content_id = occurrences.content_id
+            JOIN runs ON runs.id = files.run_id
+            WHERE tokens.token = ? AND {0}
+            GROUP BY runs.id'''.format(run_filter), [token] + parameters).fetchall()
+        matches = dict((row[0], row) for row in rows)
+        if runs is None:
+            runs = dict((run_id, (row[1:6], {token: row[6]})) for run_id, row in matches.items())
+        else:
+            runs = dict((run_id, (run, dict(counts, **{token: matches[run_id][6]}))) for run_id, (run, counts) in runs.items() if run_id in matches)
+    results = []
+    for run, counts in sorted((runs or {}).values(), key=lambda r: r[0][4], reverse=True):
+        results.append(dict(zip(['run_name', 'hostname', 'platform', 'database_type', 'indexed_at'], run), counts=counts))
+    return results
+
+# where token was seen: (run name, hostname, path, line number), newest runs first
+def find_lines(connection, token, platform=None, database_type=None, since_days=None, limit=100):
+    run_filter, parameters = get_run_filter(platform, database_type, since_days)
+    return connection.execute('''
+        SELECT runs.run_name, runs.hostname, files.path, postings.line_number
+        FROM tokens
+        JOIN postings ON postings.token_id = tokens.id
+        JOIN files ON files.content_id = postings.content_id
+        JOIN runs ON runs.id = files.run_id
+        WHERE tokens.token = ? AND {0}
+        ORDER BY runs.indexed_at DESC, runs.hostname, files.path, postings.line_number
+        LIMIT ?'''.format(run_filter), [token] + parameters + [limit]).fetchall()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index gathered iRODS logs and search them')
+    parser.add_argument('--database_file', type=str)
+    subparsers = parser.add_subparsers(dest='command')
+    index_parser = subparsers.add_parser('index', help='index the logs gathered from a deployment')
+    index_parser.add_argument('--zone_bundle_input', type=str, required=True)
+    index_parser.add_argument('--output_root_directory', type=str, required=True)
+    index_parser.add_argument('--run_name', type=str, required=True)
+    for command, help_text in [('runs', 'runs whose logs contain all of the tokens'), ('lines', 'files and lines a token was seen on')]:
+        query_parser = subparsers.add_parser(command, help=help_text)
+        query_parser.add_argument('tokens', nargs='+', help='e.g. CAT_SQL_ERR, -806000, test_iput_large_file, date:2016-03-01')
+        query_parser.add_argument('--platform', type=str, help='e.g. CentOS_7')
+        query_parser.add_argument('--database_type', type=str, help='e.g. postgres')
+        query_parser.add_argument('--since_days', type=float, help='only runs indexed in the last this many days')
+    args = parser.parse_args()
+
+    library.register_log_handlers()
+
+    if args.command == 'index':
+        with open(args.zone_bundle_input) as f:
+            zone_bundle = json.load(f)
+        index_gathered_logs(zone_bundle, args.output_root_directory, args.run_name, args.database_file)
+    else:
+        connection = open_log_index_database(args.database_file)
+        if args.command == 'runs':
+            results = find_runs(connection, args.tokens, args.platform, args.database_type, args.since_days)
+        else:
+            results = [find_lines(connection, token, args.platform, args.database_type, args.since_days) for token in args.tokens]
+        print(json.dumps(results, indent=4, sort_keys=True))
@@ -1,25 +1,124 @@
 import argparse
+import json
+import logging
+import os
 import sys
+import time
+import traceback
 
 import library
 
 
-def run_ansible_module(run_name, ansible_module, ansible_arguments, sudo=False, platform_targets=None, ansible_module_directories=None, leak_vms=False):
+def run_ansible_module(run_name, ansible_module, ansible_arguments, sudo=False, platform_targets=None, ansible_module_directories=None, leak_vms=False, external_artifacts=None, output_directory=None, required_platform_targets=None, fail_fast=False):
     if platform_targets is None:
         platform_targets = [('CentOS', '6'), ('CentOS', '7'), ('Ubuntu', '12'), ('Ubuntu', '14'), ('openSUSE ', '13')]
     else:
         platform_targets = eval(platform_targets) # e.g.  platform_targets = [('CentOS', '6'), ('Ubuntu', '12'), ('Ubuntu', '14'), ('openSUSE ', '13')]
 
+    if required_platform_targets is None:
+        required_platform_targets = platform_targets
+    else:
+        required_platform_targets = eval(required_platform_targets)
+
     if ansible_module_directories is None:
         ansible_module_directories = []
 
-    vm_names, ip_addresses = library.deploy_vms_return_names_and_ips(run_name, platform_targets)
-    with library.vm_manager(vm_names, leak_vms):
-        run_ansible_module_on_vms(ip_addresses, ansible_module, ansible_arguments, sudo, ansible_module_directories)
+    if output_directory is not None:
+        library.makedirs_catch_preexisting(output_directory)
+
+    library.update_git_mirrors([value for key, value in ansible_arguments.items() if 'git_repository' in key])
+    ansible_arguments = add_configured_arguments(ansible_module, ansible_arguments, ansible_module_directories)
+
+    # each platform is deployed, run, and destroyed on its own so fast platforms don't wait on slow ones
+    logger = logging.getLogger(__name__)
+    proc_pool = library.RecursiveMultiprocessingPool(len(platform_targets), initializer=library.convert_sigterm_to_exception, maxtasksperchild=1)
+    job_arguments = [(run_name, platform_target, ansible_module, ansible_arguments, sudo, ansible_module_directories, leak_vms, external_artifacts, output_directory)
+                     for platform_target in platform_targets]
+    platform_results = []
+    try:
+        for platform_result in proc_pool.imap_unordered(run_ansible_module_on_platform_star, job_arguments):
+            platform_results.append(platform_result)
+            if platform_result['succeeded']:
+                logger.info('%s succeeded in %d seconds', platform_result['platform'], platform_result['duration'])
+            else:
+                logger.error('%s failed in %d seconds\n%s', platform_result['platform'], platform_result['duration'], platform_result['error'])
+                if fail_fast and tuple(platform_result['platform_target']) in required_platform_targets:
+                    logger.error('required platform %s failed, stopping remaining platforms', platform_result['platform'])
+                    break
+    finally:
+        # the workers' initializer converts SIGTERM into SystemExit, so their VMs are still destroyed
+        proc_pool.terminate()
+        proc_pool.join()
+        if output_directory is not None:
+            with open(os.path.join(output_directory, 'platform_results.json'), 'w') as f:
+                json.dump(platform_results, f, indent=4, sort_keys=True)
+
+    failed_platforms = [platform_result['platform'] for platform_result in platform_results if not platform_result['succeeded']]
+    missing_platforms = len(platform_targets) - len(platform_results)
+    if failed_platforms or missing_platforms:
+        raise library.IrodsAnsibleException('ansible module [{0}] failed on {1}, {2} platforms not run'.format(ansible_module, failed_platforms, missing_platforms))
+    return platform_results
+
+# the shared caches and pinned digests are configured on the controller, modules taking them get them here
+def add_configured_arguments(ansible_module, ansible_arguments, ansible_module_directories):
+    configured_arguments = {
+        'artifact_cache_root_directory': library.get_artifact_cache_root_directory(),
+        'external_source_sha256s': library.get_external_source_sha256s(),
+    }
+    ansible_arguments = dict(ansible_arguments)
+    for key, value in configured_arguments.items():
+        if key not in ansible_arguments and ansible_module_takes_argument(ansible_module, key, ansible_module_directories):
+            ansible_arguments[key] = value
+    return ansible_arguments
+
+def ansible_module_takes_argument(ansible_module, key, ansible_module_directories):
+    for directory in [library.get_ansible_modules_directory()] + ansible_module_directories:
+        module_file = os.path.join(directory, ansible_module + '.py')
+        if os.path.isfile(module_file):
+            with open(module_file) as f:
+                return '{0}=dict('.format(key) in f.read()
+    return False
+
+def get_platform_name(platform_target):
+    return '{0}_{1}'.format(platform_target[0].strip(), platform_target[1])
+
+def run_ansible_module_on_platform_star(args):
+    return run_ansible_module_on_platform(*args)
+
+def run_ansible_module_on_platform(run_name, platform_target, ansible_module, ansible_arguments, sudo, ansible_module_directories, leak_vms, external_artifacts, output_directory):
+    platform = get_platform_name(platform_target)
+    log_handler = None
+    if output_directory is not None:
+        log_handler = logging.FileHandler(os.path.join(output_directory, platform + '.log'))
+        log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)7s - %(pathname)s:%(lineno)4d\n%(message)s'))
+        logging.getLogger().addHandler(log_handler)
+
+    platform_result = {'platform': platform, 'platform_target': platform_target, 'succeeded': False, 'error': None}
+    start = time.time()
+    try:
+        vm_names, ip_addresses = library.deploy_vms_return_names_and_ips(run_name, [platform_target])
+        with library.vm_manager(vm_names, leak_vms):
+            library.push_external_artifacts(ip_addresses, external_artifacts)
+            data = run_ansible_module_on_vms(ip_addresses, ansible_module, ansible_arguments, sudo, ansible_module_directories)
+        platform_result['result'] = data['contacted'][ip_addresses[0]]
+        platform_result['succeeded'] = True
+    except Exception:
+        platform_result['error'] = traceback.format_exc()
+        logging.getLogger(__name__).error(platform_result['error'])
+    finally:
+        platform_result['duration'] = time.time() - start
+        if log_handler is not None:
+            logging.getLogger().removeHandler(log_handler)
+            log_handler.close()
+
+    if output_directory is not None:
+        with open(os.path.join(output_directory, platform + '.json'), 'w') as f:
+            json.dump(platform_result, f, indent=4, sort_keys=True)
+    return platform_result
 
 def run_ansible_module_on_vms(ip_addresses, ansible_module, ansible_arguments, sudo, ansible_module_directories):
-    library.run_ansible(module_name=ansible_module, complex_args=ansible_arguments,
-                        host_list=ip_addresses, additional_modules_directories=ansible_module_directories, sudo=sudo)
+    return library.run_ansible(module_name=ansible_module, complex_args=ansible_arguments,
+                               host_list=ip_addresses, additional_modules_directories=ansible_module_directories, sudo=sudo)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Build iRODS packages')
@@ -30,6 +129,10 @@ if __name__ == '__main__':
     parser.add_argument('--platform_targets', type=str)
     parser.add_argument('--sudo', action='store_true')
     parser.add_argument('--leak_vms', action='store_true')
+    parser.add_argument('--external_artifacts', nargs='+', default=[], choices=sorted(library.external_artifact_sources))
+    parser.add_argument('--output_directory', type=str, help='per-platform logs and results are written here as each platform finishes')
+    parser.add_argument('--required_platform_targets', type=str, help='platforms whose failure stops the run with --fail_fast, defaults to all')
+    parser.add_argument('--fail_fast', action='store_true')
     args = parser.parse_args()
 
     if len(args.ansible_arguments) % 2 != 0:
@@ -39,4 +142,5 @@ if __name__ == '__main__':
     library.register_log_handlers()
     library.convert_sigterm_to_exception()
 
-    run_ansible_module(args.run_name, args.ansible_module, ansible_arguments, args.sudo, args.platform_targets, args.ansible_module_directories, args.leak_vms)
+    run_ansible_module(args.run_name, args.ansible_module, ansible_arguments, args.sudo, args.platform_targets, args.ansible_module_directories, args.leak_vms, args.external_artifacts,
+                       args.output_directory, args.required_platform_targets, args.fail_fast)
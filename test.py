@@ -2,16 +2,75 @@ import argparse
 import contextlib
 import copy
 import json
+import logging
 import multiprocessing
 import os
+import re
 import shutil
 import sys
 import tempfile
+import time
+import traceback
+import xml.etree.ElementTree
 
 import configuration
 import library
 
 
+# aborts a run after max_failures failed tests, or when at least max_failure_rate of the first
+# failure_rate_window tests failed
+class FailureThreshold(object):
+    def __init__(self, max_failures=None, max_failure_rate=None, failure_rate_window=None):
+        self.max_failures = max_failures
+        self.max_failure_rate = max_failure_rate
+        self.failure_rate_window = failure_rate_window
+
+    def exceeded(self, tests_run, tests_failed):
+        if self.max_failures is not None and tests_failed >= self.max_failures:
+            return '{0} tests failed'.format(tests_failed)
+        if self.max_failure_rate is not None and self.failure_rate_window and tests_run == self.failure_rate_window:
+            if float(tests_failed) / tests_run >= self.max_failure_rate:
+                return '{0} of the first {1} tests failed'.format(tests_failed, tests_run)
+        return None
+
+# counts unittest's verbose result lines ("test_name (module.Class) ... ok") in the streamed test output,
+# a test that prints puts its status on a line of its own after the output. Concurrent partitions interleave
+# their lines, so several tests can be awaiting their status at once.
+class TestOutputMonitor(object):
+    test_line = re.compile(r'^\S+ \([\w.]+\) \.\.\. ?(ok|OK|FAIL|ERROR|skipped)?\b')
+    status_line = re.compile(r'^(ok|OK|FAIL|ERROR|skipped)\b')
+
+    def __init__(self, failure_threshold):
+        self.failure_threshold = failure_threshold
+        self.partial_line = ''
+        self.awaiting_statuses = 0
+        self.tests_run = 0
+        self.tests_failed = 0
+        self.abort_reason = None
+
+    def feed(self, data):
+        lines = (self.partial_line + data).split('\n')
+        self.partial_line = lines.pop()
+        for line in lines:
+            status = None
+            match = self.test_line.match(line)
+            if match:
+                status = match.group(1)
+                if status is None:
+                    self.awaiting_statuses += 1
+            elif self.awaiting_statuses:
+                match = self.status_line.match(line)
+                if match:
+                    status = match.group(1)
+                    self.awaiting_statuses -= 1
+            if status is None or status == 'skipped':
+                continue
+            self.tests_run += 1
+            if match.group(1) in ['FAIL', 'ERROR']:
+                self.tests_failed += 1
+            if self.abort_reason is None:
+                self.abort_reason = self.failure_threshold.exceeded(self.tests_run, self.tests_failed)
+
 @contextlib.contextmanager
 def directory_deleter(dirname):
     try:
@@ -19,14 +78,95 @@ def directory_deleter(dirname):
     finally:
         shutil.rmtree(dirname)
 
-def test(zone_bundle, test_type, use_ssl, use_mungefs, output_directory):
-    return test_zone_bundle(zone_bundle, test_type, use_ssl, use_mungefs, output_directory)
+def test(zone_bundle, test_type, use_ssl, use_mungefs, output_directory, concurrent_federation=False, failure_threshold=None, max_reruns=0, test_partitions=1):
+    return test_zone_bundle(zone_bundle, test_type, use_ssl, use_mungefs, output_directory, concurrent_federation, failure_threshold, max_reruns, test_partitions)
 
-def test_zone_bundle(zone_bundle, test_type, use_ssl, use_mungefs, output_directory):
+def test_zone_bundle(zone_bundle, test_type, use_ssl, use_mungefs, output_directory, concurrent_federation=False, failure_threshold=None, max_reruns=0, test_partitions=1):
     library.makedirs_catch_preexisting(output_directory)
     if test_type == 'federation':
+        if concurrent_federation:
+            return test_federation_concurrently(zone_bundle, use_ssl, use_mungefs, output_directory)
         return test_federation(zone_bundle, use_ssl, use_mungefs, output_directory)
-    return test_zone(zone_bundle['zones'][0], test_type, use_ssl, use_mungefs, output_directory)
+    return test_zone(zone_bundle['zones'][0], test_type, use_ssl, use_mungefs, output_directory, failure_threshold=failure_threshold, max_reruns=max_reruns, test_partitions=test_partitions)
+
+# zone_bundles are identically configured deployments, the suite is split across their first zones.
+# select_tests, if given, narrows the suite's test modules (see test_selection.select_tests)
+def test_sharded(zone_bundles, test_type, use_ssl, use_mungefs, output_directory, test_durations=None, concurrent_federation=False, select_tests=None, failure_threshold=None, max_reruns=0, test_partitions=1):
+    library.makedirs_catch_preexisting(output_directory)
+    zones = [zone_bundle['zones'][0] for zone_bundle in zone_bundles]
+    test_identifiers = []
+    if test_type != 'federation' and (len(zones) > 1 or select_tests is not None):
+        test_identifiers = list_test_identifiers(zones[0], test_type)
+    if not test_identifiers:
+        return test_zone_bundle(zone_bundles[0], test_type, use_ssl, use_mungefs, output_directory, concurrent_federation, failure_threshold, max_reruns, test_partitions)
+    if select_tests is not None:
+        test_identifiers = select_tests(test_identifiers)
+        if not test_identifiers:
+            return True
+
+    shards = [shard for shard in balance_test_shards(test_identifiers, len(zones), test_durations) if shard]
+    shard_output_directories = [os.path.join(output_directory, 'shards', str(i)) for i in range(len(shards))]
+    proc_pool = library.RecursiveMultiprocessingPool(len(shards))
+    proc_pool_results = [proc_pool.apply_async(test_zone, (zone, test_type, use_ssl, use_mungefs, shard_output_directory, shard, i == 0, failure_threshold, max_reruns, test_partitions, test_durations))
+                         for i, (zone, shard, shard_output_directory) in enumerate(zip(zones, shards, shard_output_directories))]
+    tests_passed = [result.get() for result in proc_pool_results]
+    merge_shard_outputs(shard_output_directories, output_directory)
+    return all(tests_passed)
+
+def list_test_identifiers(zone, test_type):
+    test_server_ip = get_test_server_ip(zone, test_type)
+    data = library.run_ansible(module_name='irods_testing_list_tests', complex_args={}, host_list=[test_server_ip])
+    return data['contacted'][test_server_ip]['test_identifiers']
+
+# longest processing time first, tests without history count as the average known duration
+def balance_test_shards(test_identifiers, shard_count, test_durations=None):
+    if not test_durations:
+        test_durations = {}
+    known_durations = [test_durations[t] for t in test_identifiers if t in test_durations]
+    default_duration = float(sum(known_durations)) / len(known_durations) if known_durations else 1.0
+    def duration(test_identifier):
+        return test_durations.get(test_identifier, default_duration)
+
+    shards = [[] for _ in range(shard_count)]
+    shard_durations = [0.0] * shard_count
+    for test_identifier in sorted(test_identifiers, key=lambda t: (-duration(t), t)):
+        i = shard_durations.index(min(shard_durations))
+        shards[i].append(test_identifier)
+        shard_durations[i] += duration(test_identifier)
+    return shards
+
+def merge_shard_outputs(shard_output_directories, output_directory):
+    merged_results = xml.etree.ElementTree.Element('testsuites')
+    merged_reruns = {'flaky': [], 'failed': []}
+    with open(os.path.join(output_directory, 'test_output.txt'), 'w') as merged_output:
+        for i, shard_output_directory in enumerate(shard_output_directories):
+            for hostname in sorted(os.listdir(shard_output_directory)):
+                host_output_directory = os.path.join(shard_output_directory, hostname)
+                if not os.path.isdir(host_output_directory):
+                    continue
+                merged_output.write('===== shard {0} ({1}) =====\n'.format(i, hostname))
+                with open(os.path.join(host_output_directory, 'test_output.txt')) as f:
+                    shutil.copyfileobj(f, merged_output)
+                test_reports_directory = os.path.join(host_output_directory, 'test-reports')
+                if os.path.isdir(test_reports_directory):
+                    for basename in sorted(os.listdir(test_reports_directory)):
+                        if basename.endswith('.xml'):
+                            root = xml.etree.ElementTree.parse(os.path.join(test_reports_directory, basename)).getroot()
+                            merged_results.extend(list(root) if root.tag == 'testsuites' else [root])
+            rerun_results_file = os.path.join(shard_output_directory, 'flaky_tests.json')
+            if os.path.exists(rerun_results_file):
+                with open(rerun_results_file) as f:
+                    rerun_results = json.load(f)
+                for key in merged_reruns:
+                    merged_reruns[key].extend(rerun_results[key])
+
+    for attribute in ['tests', 'failures', 'errors', 'skipped']:
+        merged_results.set(attribute, str(sum(int(suite.get(attribute, 0)) for suite in merged_results)))
+    merged_results.set('time', str(sum(float(suite.get('time', 0)) for suite in merged_results)))
+    xml.etree.ElementTree.ElementTree(merged_results).write(os.path.join(output_directory, 'test_results.xml'), encoding='utf-8')
+    if merged_reruns['flaky'] or merged_reruns['failed']:
+        with open(os.path.join(output_directory, 'flaky_tests.json'), 'w') as f:
+            json.dump(merged_reruns, f, indent=4, sort_keys=True)
 
 def test_federation(zone_bundle, use_ssl, use_mungefs, output_directory):
     zone0 = zone_bundle['zones'][0]
@@ -40,13 +180,51 @@ def test_federation(zone_bundle, use_ssl, use_mungefs, output_directory):
     data = test_federation_zone_to_zone(zone1, zone0, use_ssl, use_mungefs, output_directory)
     return data['contacted'][zone1['icat_server']['deployment_information']['ip_address']]['tests_passed']
 
+# zone1 runs zone0's test code in both modes, it is copied before either direction starts
+def test_federation_concurrently(zone_bundle, use_ssl, use_mungefs, output_directory):
+    zone0 = zone_bundle['zones'][0]
+    zone1 = zone_bundle['zones'][1]
+    directions = [(zone0, zone1), (zone1, zone0)]
+
+    copy_testing_code(zone0, zone1)
+    for local_zone, remote_zone in directions:
+        prepare_federation_zone_to_zone(local_zone, remote_zone)
+
+    proc_pool = library.RecursiveMultiprocessingPool(len(directions))
+    proc_pool_results = [proc_pool.apply_async(run_federation_tests_zone_to_zone_and_report, (local_zone, remote_zone, use_ssl, use_mungefs, output_directory))
+                         for local_zone, remote_zone in directions]
+    reports = [result.get() for result in proc_pool_results]
+    with open(os.path.join(output_directory, 'federation_results.json'), 'w') as f:
+        json.dump(reports, f, indent=4, sort_keys=True)
+    return all(report['tests_passed'] for report in reports)
+
+def run_federation_tests_zone_to_zone_and_report(local_zone, remote_zone, use_ssl, use_mungefs, output_directory):
+    report = {
+        'local_zone': local_zone['icat_server']['server_config']['zone_name'],
+        'remote_zone': remote_zone['icat_server']['server_config']['zone_name'],
+        'tests_passed': False,
+    }
+    start = time.time()
+    try:
+        data = run_federation_tests_zone_to_zone(local_zone, remote_zone, use_ssl, use_mungefs, output_directory)
+        report['tests_passed'] = data['contacted'][local_zone['icat_server']['deployment_information']['ip_address']]['tests_passed']
+    except Exception:
+        report['error'] = traceback.format_exc()
+    report['duration'] = time.time() - start
+    return report
+
 def test_federation_zone_to_zone(local_zone, remote_zone, use_ssl, use_mungefs, output_directory):
+    prepare_federation_zone_to_zone(local_zone, remote_zone)
+    return run_federation_tests_zone_to_zone(local_zone, remote_zone, use_ssl, use_mungefs, output_directory)
+
+def prepare_federation_zone_to_zone(local_zone, remote_zone):
     complex_args = {
         'username': 'zonehopper#{0}'.format(local_zone['icat_server']['server_config']['zone_name'])
     }
     remote_icat_ip = remote_zone['icat_server']['deployment_information']['ip_address']
     library.run_ansible(module_name='irods_configuration_federation_testing', complex_args=complex_args, host_list=[remote_icat_ip], sudo=True)
 
+def run_federation_tests_zone_to_zone(local_zone, remote_zone, use_ssl, use_mungefs, output_directory):
     complex_args = {
         'test_type': 'federation',
         'output_directory': output_directory,
@@ -57,10 +235,69 @@ def test_federation_zone_to_zone(local_zone, remote_zone, use_ssl, use_mungefs,
                             remote_zone['icat_server']['hostname'],]
     }
     local_icat_ip = local_zone['icat_server']['deployment_information']['ip_address']
-    data = library.run_ansible(module_name='irods_testing', complex_args=complex_args, host_list=[local_icat_ip])
+    data = run_irods_testing(local_icat_ip, complex_args, output_directory)
     return data
 
+# runs irods_testing as an ansible background job, tailing test_output.txt into the log and
+# output_directory/test_output_<ip>.txt until it finishes, or stopping it early once failure_threshold is exceeded
+def run_irods_testing(test_server_ip, complex_args, output_directory, poll_interval_seconds=30, failure_threshold=None):
+    logger = logging.getLogger(__name__)
+    job_ids = library.run_ansible_in_background(host_list=[test_server_ip], timeout_seconds=7*24*60*60, module_name='irods_testing', complex_args=complex_args)
+    live_output_file = os.path.join(output_directory, 'test_output_{0}.txt'.format(test_server_ip))
+    tail_state = {'inode': None, 'offset': 0}
+    monitor = TestOutputMonitor(failure_threshold) if failure_threshold else None
+    aborted = False
+    async_job_file = library.get_ansible_async_job_file(job_ids[test_server_ip])
+    with open(live_output_file, 'w') as live_output:
+        while True:
+            result = tail_test_output(test_server_ip, tail_state, live_output, monitor, async_job_file)
+            if result.get('finished'):
+                data = {'contacted': {test_server_ip: result}, 'dark': {}}
+                if library.ansible_run_failed(data):
+                    logger.error(library.format_ansible_output(data))
+                    raise library.IrodsAnsibleException('ansible failed')
+                logger.info(library.format_ansible_output(data))
+                if aborted:
+                    result['aborted'] = monitor.abort_reason
+                return data
+            if monitor and monitor.abort_reason and not aborted:
+                logger.error('aborting tests on %s: %s', test_server_ip, monitor.abort_reason)
+                abort_irods_testing(test_server_ip)
+                aborted = True
+                continue
+            time.sleep(poll_interval_seconds)
+
+def abort_irods_testing(test_server_ip):
+    abort_command = 'touch {0}; pkill -TERM -f "python run_tests.py" || true'.format(library.remote_irods_testing_abort_file)
+    library.run_ansible(module_name='shell', module_args=abort_command, host_list=[test_server_ip], sudo=True)
+
+# one module call per poll returns both the background job's status and the new output up to the end of the file
+def tail_test_output(test_server_ip, tail_state, live_output, monitor, async_job_file):
+    complex_args = {'offset': tail_state['offset'], 'inode': tail_state['inode'], 'async_job_file': async_job_file}
+    data = library.run_ansible(module_name='irods_test_output', complex_args=complex_args, host_list=[test_server_ip], sudo=True, log_output=False)
+    chunk = data['contacted'][test_server_ip]
+    tail_state['inode'] = chunk['inode']
+    tail_state['offset'] = chunk['offset']
+    if chunk['data']:
+        live_output.write(chunk['data'].encode('utf-8'))
+        live_output.flush()
+        if monitor:
+            monitor.feed(chunk['data'])
+        logging.getLogger(__name__).info('%s test output:\n%s', test_server_ip, chunk['data'])
+    return chunk['job']
+
 def copy_testing_code(source_zone, target_zone):
+    ip_address_source = source_zone['icat_server']['deployment_information']['ip_address']
+    ip_address_dest = target_zone['icat_server']['deployment_information']['ip_address']
+    if '3.3.1' not in [zone['icat_server']['version']['irods_version'] for zone in [source_zone, target_zone]]:
+        try:
+            library.run_ansible(module_name='irods_testing_code_transfer', complex_args={'source_host': ip_address_source}, host_list=[ip_address_dest], sudo=True)
+            return
+        except library.IrodsAnsibleException:
+            logging.getLogger(__name__).warning('streaming the testing code from %s failed, copying it through the controller', ip_address_source)
+    copy_testing_code_through_controller(source_zone, target_zone)
+
+def copy_testing_code_through_controller(source_zone, target_zone):
     ip_address_source = source_zone['icat_server']['deployment_information']['ip_address']
     ip_address_dest = target_zone['icat_server']['deployment_information']['ip_address']
     temp_dir = tempfile.mkdtemp()
@@ -120,7 +357,8 @@ def get_first_zone_irods_version(zone_bundle):
     data = library.run_ansible(module_name='irods_version', complex_args={}, host_list=[icat_ip])
     return data['contacted'][icat_ip]['irods_version']
 
-def test_zone(zone, test_type, use_ssl, use_mungefs, output_directory):
+# test_partitions > 1 splits the (selected) test modules into that many partitions run concurrently on the test server
+def test_zone(zone, test_type, use_ssl, use_mungefs, output_directory, test_identifiers=None, run_suite_extras=True, failure_threshold=None, max_reruns=0, test_partitions=1, test_durations=None):
     test_server_ip = get_test_server_ip(zone, test_type)
 
     complex_args = {
@@ -129,9 +367,51 @@ def test_zone(zone, test_type, use_ssl, use_mungefs, output_directory):
         'use_ssl': use_ssl,
         'use_mungefs': use_mungefs,
     }
+    if test_identifiers:
+        complex_args['test_identifiers'] = test_identifiers
+        complex_args['run_suite_extras'] = run_suite_extras
+    if test_partitions > 1 and test_type != 'federation':
+        partitions = balance_test_shards(test_identifiers or list_test_identifiers(zone, test_type), test_partitions, test_durations)
+        complex_args['test_partitions'] = [partition for partition in partitions if partition]
+        complex_args['run_suite_extras'] = run_suite_extras
+
+    library.makedirs_catch_preexisting(output_directory)
+    data = run_irods_testing(test_server_ip, complex_args, output_directory, failure_threshold=failure_threshold)
+    result = data['contacted'][test_server_ip]
+    if result['tests_passed'] or not max_reruns or result.get('aborted') or not result['failed_tests']:
+        return result['tests_passed']
+    return rerun_failed_tests(test_server_ip, complex_args, output_directory, result['failed_tests'], max_reruns)
 
-    data = library.run_ansible(module_name='irods_testing', complex_args=complex_args, host_list=[test_server_ip])
-    return data['contacted'][test_server_ip]['tests_passed']
+# reruns only the failed tests on the same deployment, up to max_reruns times, and records the ones
+# that passed on a retry as flaky in output_directory/flaky_tests.json
+def rerun_failed_tests(test_server_ip, complex_args, output_directory, failed_tests, max_reruns):
+    logger = logging.getLogger(__name__)
+    remaining = list(failed_tests)
+    for attempt in range(1, max_reruns + 1):
+        logger.info('rerunning %d failed tests on %s, attempt %d of %d:\n%s', len(remaining), test_server_ip, attempt, max_reruns, '\n'.join(remaining))
+        rerun_complex_args = dict(complex_args, test_identifiers=remaining, run_suite_extras=False, attempt=attempt, test_partitions=[])
+        result = run_irods_testing(test_server_ip, rerun_complex_args, output_directory)['contacted'][test_server_ip]
+        if result['tests_passed']:
+            remaining = []
+        elif result['failed_tests']:
+            remaining = [t for t in remaining if t in result['failed_tests']]
+        if not remaining:
+            break
+
+    rerun_results = {
+        'flaky': [t for t in failed_tests if t not in remaining],
+        'failed': remaining,
+    }
+    with open(os.path.join(output_directory, 'flaky_tests.json'), 'w') as f:
+        json.dump(rerun_results, f, indent=4, sort_keys=True)
+    if rerun_results['flaky']:
+        logger.warning('flaky tests on %s, failed then passed on a rerun:\n%s', test_server_ip, '\n'.join(rerun_results['flaky']))
+    return not remaining
+
+def get_failure_threshold_from_arguments(args):
+    if args.abort_after_failures is None and args.abort_failure_rate is None:
+        return None
+    return FailureThreshold(args.abort_after_failures, args.abort_failure_rate, args.abort_failure_rate_window)
 
 def get_test_server_ip(zone, test_type):
     if test_type in {'standalone_icat', 'topology_icat'}:
@@ -143,10 +423,17 @@ def get_test_server_ip(zone, test_type):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Test deployed Zone')
     parser.add_argument('--zone_bundle_input', type=str, required=True)
+    parser.add_argument('--shard_zone_bundle_inputs', type=str, nargs='+', default=[], help='identically configured deployments to split the suite across')
     parser.add_argument('--test_type', type=str, required=True, choices=['standalone_icat', 'topology_icat', 'topology_resource', 'federation'])
     parser.add_argument('--output_directory', type=str, required=True)
     parser.add_argument('--use_ssl', action='store_true')
     parser.add_argument('--use_mungefs', action='store_true')
+    parser.add_argument('--concurrent_federation', action='store_true', help='run both federation directions at once')
+    parser.add_argument('--abort_after_failures', type=int, help='stop the tests once this many have failed')
+    parser.add_argument('--abort_failure_rate', type=float, help='stop the tests if this fraction of the first --abort_failure_rate_window tests failed')
+    parser.add_argument('--abort_failure_rate_window', type=int, default=50)
+    parser.add_argument('--rerun_failed_tests', type=int, default=0, help='rerun only the failed tests up to this many times, passing on a retry marks them flaky')
+    parser.add_argument('--test_partitions', type=int, default=1, help='run the suite as this many concurrent partitions of test modules on each test server')
 
     args = parser.parse_args()
 
@@ -156,5 +443,12 @@ if __name__ == '__main__':
     library.register_log_handlers()
     library.convert_sigterm_to_exception()
 
-    if not test_zone_bundle(zone_bundle, args.test_type, args.use_ssl, args.use_mungefs, args.output_directory):
+    shard_zone_bundles = []
+    for shard_zone_bundle_input in args.shard_zone_bundle_inputs:
+        with open(shard_zone_bundle_input) as f:
+            shard_zone_bundles.append(json.load(f))
+
+    if not test_sharded([zone_bundle] + shard_zone_bundles, args.test_type, args.use_ssl, args.use_mungefs, args.output_directory, concurrent_federation=args.concurrent_federation,
+                        failure_threshold=get_failure_threshold_from_arguments(args), max_reruns=args.rerun_failed_tests,
+                        test_partitions=args.test_partitions):
         sys.exit(1)
@@ -0,0 +1,194 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import time
+import xml.etree.ElementTree
+
+import configuration
+import gather
+import library
+
+
+def get_test_history_database_file():
+    # optional, a local path (sqlite locking is unreliable on network filesystems)
+    database_file = getattr(configuration, 'test_history_database_file', None)
+    return database_file or os.path.expanduser('~/.irods_testing_zone_bundle/test_history.sqlite')
+
+def open_test_history_database(database_file=None):
+    if database_file is None:
+        database_file = get_test_history_database_file()
+    library.makedirs_catch_preexisting(os.path.dirname(os.path.abspath(database_file)))
+    connection = sqlite3.connect(database_file, timeout=60)
+    connection.executescript('''
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            run_name TEXT NOT NULL,
+            hostname TEXT NOT NULL,
+            platform TEXT,
+            database_type TEXT,
+            irods_version TEXT,
+            recorded_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS test_results (
+            run_id INTEGER NOT NULL REFERENCES runs(id),
+            test_module TEXT NOT NULL,
+            test_class TEXT NOT NULL,
+            test_name TEXT NOT NULL,
+            duration REAL NOT NULL,
+            outcome TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS test_results_by_test ON test_results (test_class, test_name);
+        CREATE INDEX IF NOT EXISTS test_results_by_run ON test_results (run_id);
+    ''')
+    return connection
+
+def get_server_platform(server):
+    host_system_information = server['host_system_information']
+    return '{0}_{1}'.format(host_system_information['os_distribution_name'].strip(), host_system_information['os_distribution_version'].split('.')[0])
+
+def get_zone_database_type(zone):
+    return zone['icat_server']['database_config'].get('catalog_database_type')
+
+# the test-reports XML is among each host's gathered files (see gather.iterate_gathered_host_files)
+def record_gathered_test_reports(zone_bundle, output_root_directory, run_name, database_file=None):
+    logger = logging.getLogger(__name__)
+    connection = open_test_history_database(database_file)
+    try:
+        for zone in zone_bundle['zones']:
+            for server in library.get_servers_from_zone(zone):
+                run_id = None
+                report_count = 0
+                with connection:
+                    for _, report, _ in gather.iterate_gathered_host_files(output_root_directory, server['hostname'], is_test_report):
+                        if run_id is None:
+                            run_id = connection.execute('INSERT INTO runs (run_name, hostname, platform, database_type, irods_version, recorded_at) VALUES (?, ?, ?, ?, ?, ?)',
+                                                        (run_name, server['hostname'], get_server_platform(server), get_zone_database_type(zone), server['version']['irods_version'], time.time())).lastrowid
+                        record_test_report(connection, run_id, report)
+                        report_count += 1
+                if run_id is None:
+                    continue
+                logger.info('recorded %d test reports from %s in the test history', report_count, server['hostname'])
+    finally:
+        connection.close()
+
+def is_test_report(path):
+    basename = os.path.basename(path)
+    return basename.startswith('TEST-') and basename.endswith('.xml')
+
+def record_test_report(connection, run_id, report_file):
+    rows = []
+    for _, element in xml.etree.ElementTree.iterparse(report_file):
+        if element.tag != 'testcase':
+            continue
+        test_class = element.get('classname', '')
+        outcome = 'passed'
+        for child_tag in ['failure', 'error', 'skipped']:
+            if element.find(child_tag) is not None:
+                outcome = child_tag
+                break
+        rows.append((run_id, test_class.split('.')[0], test_class, element.get('name', ''), float(element.get('time', 0)), outcome))
+        element.clear()
+    connection.executemany('INSERT INTO test_results (run_id, test_module, test_class, test_name, duration, outcome) VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+def get_run_filter(platform, database_type):
+    clauses = []
+    parameters = []
+    if platform is not None:
+        clauses.append('runs.platform = ?')
+        parameters.append(platform)
+    if database_type is not None:
+        clauses.append('runs.database_type = ?')
+        parameters.append(database_type)
+    return ' AND '.join(clauses) or '1', parameters
+
+def get_slowest_tests(connection, limit=20, platform=None, database_type=None):
+    run_filter, parameters = get_run_filter(platform, database_type)
+    return connection.execute('''
+        SELECT test_class, test_name, AVG(duration) AS average_duration, MAX(duration), COUNT(*)
+        FROM test_results JOIN runs ON test_results.run_id = runs.id
+        WHERE outcome = 'passed' AND {0}
+        GROUP BY test_class, test_name
+        ORDER BY average_duration DESC
+        LIMIT ?'''.format(run_filter), parameters + [limit]).fetchall()
+
+# mean seconds each test module takes per run, the input test.balance_test_shards() expects
+def get_test_module_durations(connection, platform=None, database_type=None):
+    run_filter, parameters = get_run_filter(platform, database_type)
+    rows = connection.execute('''
+        SELECT test_module, SUM(duration) / COUNT(DISTINCT run_id)
+        FROM test_results JOIN runs ON test_results.run_id = runs.id
+        WHERE {0}
+        GROUP BY test_module'''.format(run_filter), parameters).fetchall()
+    return dict(rows)
+
+def get_test_module_durations_for_zone(zone, database_file=None):
+    connection = open_test_history_database(database_file)
+    try:
+        return get_test_module_durations(connection, get_server_platform(zone['icat_server']), get_zone_database_type(zone))
+    finally:
+        connection.close()
+
+# tests whose latest passing duration exceeds the median of the preceding baseline_runs by ratio
+def get_duration_regressions(connection, ratio=1.5, minimum_seconds=1.0, baseline_runs=5, platform=None, database_type=None):
+    run_filter, parameters = get_run_filter(platform, database_type)
+    durations = {}
+    for test_class, test_name, test_platform, test_database_type, duration in connection.execute('''
+            SELECT test_class, test_name, runs.platform, runs.database_type, duration
+            FROM test_results JOIN runs ON test_results.run_id = runs.id
+            WHERE outcome = 'passed' AND {0}
+            ORDER BY runs.recorded_at'''.format(run_filter), parameters):
+        durations.setdefault((test_class, test_name, test_platform, test_database_type), []).append(duration)
+
+    regressions = []
+    for key, history in sorted(durations.items()):
+        baseline = sorted(history[-baseline_runs-1:-1])
+        if not baseline:
+            continue
+        median = baseline[len(baseline) // 2]
+        latest = history[-1]
+        if latest >= minimum_seconds and latest > median * ratio:
+            regressions.append(key + (median, latest))
+    return regressions
+
+# tests that both passed and failed within the most recent recent_runs runs of a platform/database
+def get_flaky_tests(connection, recent_runs=20, platform=None, database_type=None):
+    run_filter, parameters = get_run_filter(platform, database_type)
+    return connection.execute('''
+        SELECT test_class, test_name, SUM(outcome = 'passed'), SUM(outcome IN ('failure', 'error'))
+        FROM test_results
+        WHERE run_id IN (SELECT id FROM runs WHERE {0} ORDER BY recorded_at DESC LIMIT ?)
+        GROUP BY test_class, test_name
+        HAVING SUM(outcome = 'passed') > 0 AND SUM(outcome IN ('failure', 'error')) > 0
+        ORDER BY SUM(outcome IN ('failure', 'error')) DESC'''.format(run_filter), parameters + [recent_runs]).fetchall()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record and query historical iRODS test results')
+    parser.add_argument('--database_file', type=str)
+    subparsers = parser.add_subparsers(dest='command')
+    record_parser = subparsers.add_parser('record', help='record the test reports gathered from a deployment')
+    record_parser.add_argument('--zone_bundle_input', type=str, required=True)
+    record_parser.add_argument('--output_root_directory', type=str, required=True)
+    record_parser.add_argument('--run_name', type=str, required=True)
+    for command in ['slowest', 'regressions', 'flaky', 'module_durations']:
+        query_parser = subparsers.add_parser(command)
+        query_parser.add_argument('--platform', type=str, help='e.g. Ubuntu_14')
+        query_parser.add_argument('--database_type', type=str, help='e.g. postgres')
+    args = parser.parse_args()
+
+    library.register_log_handlers()
+
+    if args.command == 'record':
+        with open(args.zone_bundle_input) as f:
+            zone_bundle = json.load(f)
+        record_gathered_test_reports(zone_bundle, args.output_root_directory, args.run_name, args.database_file)
+    else:
+        connection = open_test_history_database(args.database_file)
+        queries = {
+            'slowest': get_slowest_tests,
+            'regressions': get_duration_regressions,
+            'flaky': get_flaky_tests,
+            'module_durations': get_test_module_durations,
+        }
+        print(json.dumps(queries[args.command](connection, platform=args.platform, database_type=args.database_type), indent=4, sort_keys=True))
@@ -0,0 +1,136 @@
+import argparse
+import json
+import logging
+import os
+import posixpath
+import shutil
+import subprocess
+import tempfile
+import time
+
+import configuration
+import library
+
+
+# where the splittable suites' test modules live in the iRODS repository (see irods_testing_list_tests)
+test_module_directory = 'scripts/irods/test'
+
+def get_test_impact_mapping_file():
+    # optional, test module -> iRODS source paths it executed, recorded from coverage runs
+    mapping_file = getattr(configuration, 'test_impact_mapping_file', None)
+    return mapping_file or os.path.expanduser('~/.irods_testing_zone_bundle/test_impact_mapping.json')
+
+def load_json_file(filename, default):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except IOError as e:
+        if e.errno != 2:
+            raise
+        return default
+
+def record_test_impact_mapping(coverage_mapping, mapping_file=None):
+    if mapping_file is None:
+        mapping_file = get_test_impact_mapping_file()
+    mapping = load_json_file(mapping_file, {})
+    for test_identifier, source_paths in coverage_mapping.items():
+        mapping[test_identifier] = sorted(set(source_paths))
+    library.makedirs_catch_preexisting(os.path.dirname(os.path.abspath(mapping_file)))
+    library.write_file_atomically(mapping_file, json.dumps(mapping, indent=4, sort_keys=True))
+
+def get_changed_files(git_repository, base_commit, head_commit):
+    library.update_git_mirrors([git_repository])
+    git_mirror_root_directory = library.get_git_mirror_root_directory()
+    if git_mirror_root_directory:
+        return git_diff_names(os.path.join(git_mirror_root_directory, library.get_git_mirror_name(git_repository)), base_commit, head_commit)
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        subprocess.check_call(['git', 'clone', '--bare', '--quiet', git_repository, temp_dir])
+        return git_diff_names(temp_dir, base_commit, head_commit)
+    finally:
+        shutil.rmtree(temp_dir)
+
+def git_diff_names(git_dir, base_commit, head_commit):
+    p = subprocess.Popen(['git', '--git-dir', git_dir, 'diff', '--name-only', base_commit, head_commit], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    if p.returncode != 0:
+        raise RuntimeError('git diff [{0}] [{1}] failed: {2}'.format(base_commit, head_commit, err))
+    return [line for line in out.splitlines() if line]
+
+def full_suite_is_due(schedule_key, full_suite_interval_hours, state_file):
+    state = load_json_file(state_file, {})
+    last_full_suite = state.get(schedule_key)
+    return last_full_suite is None or time.time() - last_full_suite >= full_suite_interval_hours * 60 * 60
+
+def record_full_suite(schedule_key, state_file):
+    state = load_json_file(state_file, {})
+    state[schedule_key] = time.time()
+    library.makedirs_catch_preexisting(os.path.dirname(state_file))
+    library.write_file_atomically(state_file, json.dumps(state, indent=4, sort_keys=True))
+
+# paths are compared relative to the repository root, as git diff --name-only prints them
+def normalize_repository_path(path):
+    return posixpath.normpath(path.lstrip('/'))
+
+def get_test_module_path(test_identifier):
+    return normalize_repository_path(posixpath.join(test_module_directory, test_identifier.replace('.', '/') + '.py'))
+
+# returns (selected test identifiers, {skipped test identifier: reason}, reason for the selection mode)
+def select_impacted_tests(test_identifiers, changed_files, mapping):
+    mapping = dict((test_identifier, set(normalize_repository_path(p) for p in source_paths)) for test_identifier, source_paths in mapping.items())
+    mapped_sources = set()
+    for source_paths in mapping.values():
+        mapped_sources.update(source_paths)
+    test_files = dict((test_identifier, get_test_module_path(test_identifier)) for test_identifier in test_identifiers)
+    changed = set(normalize_repository_path(f) for f in changed_files)
+    unmapped_changes = [f for f in changed if f not in mapped_sources and f not in test_files.values()]
+    if unmapped_changes:
+        return list(test_identifiers), {}, 'changes without coverage data: {0}'.format(', '.join(sorted(unmapped_changes)[:10]))
+
+    selected = []
+    skipped = {}
+    for test_identifier in test_identifiers:
+        if test_identifier not in mapping:
+            selected.append(test_identifier) # no coverage recorded yet
+        elif test_files[test_identifier] in changed:
+            selected.append(test_identifier)
+        elif changed.intersection(mapping[test_identifier]):
+            selected.append(test_identifier)
+        else:
+            skipped[test_identifier] = 'none of the {0} sources it covers changed'.format(len(mapping[test_identifier]))
+    return selected, skipped, 'covered changes only'
+
+def select_tests(test_identifiers, git_repository, base_commit, head_commit, output_directory, schedule_key='default', full_suite_interval_hours=24, mapping_file=None):
+    logger = logging.getLogger(__name__)
+    if mapping_file is None:
+        mapping_file = get_test_impact_mapping_file()
+    state_file = os.path.join(os.path.dirname(os.path.abspath(mapping_file)), 'test_selection_state.json')
+
+    if full_suite_is_due(schedule_key, full_suite_interval_hours, state_file):
+        selected, skipped, reason = list(test_identifiers), {}, 'scheduled full suite (every {0} hours)'.format(full_suite_interval_hours)
+        record_full_suite(schedule_key, state_file)
+    else:
+        changed_files = get_changed_files(git_repository, base_commit, head_commit)
+        selected, skipped, reason = select_impacted_tests(test_identifiers, changed_files, load_json_file(mapping_file, {}))
+
+    report = {
+        'base_commit': base_commit,
+        'head_commit': head_commit,
+        'reason': reason,
+        'selected': selected,
+        'skipped': skipped,
+    }
+    with open(os.path.join(output_directory, 'test_selection.json'), 'w') as f:
+        json.dump(report, f, indent=4, sort_keys=True)
+    logger.info('running %d of %d test modules (%s), skipped: %s', len(selected), len(test_identifiers), reason, json.dumps(skipped, indent=4, sort_keys=True))
+    return selected
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintain the test impact mapping used for change-based test selection')
+    parser.add_argument('--coverage_mapping_input', type=str, required=True, help='JSON object of test module -> list of source paths it executed')
+    parser.add_argument('--mapping_file', type=str)
+    args = parser.parse_args()
+
+    with open(args.coverage_mapping_input) as f:
+        record_test_impact_mapping(json.load(f), args.mapping_file)
@@ -1,5 +1,6 @@
 import argparse
 import json
+import logging
 import os
 import sys
 
@@ -10,6 +11,8 @@ import test
 import gather
 import upgrade
 import library
+import log_index
+import test_history
 
 def list_to_dict(l):
     return {l[i]: l[i+1] for i in range(0, len(l), 2)}
@@ -48,7 +51,15 @@ def main():
              enable_ssl.enable_ssl(deployed_zone_bundle)
 
          tests_passed = test.test(deployed_zone_bundle, args.test_type, args.use_ssl, False, args.output_directory)
-         gather.gather(deployed_zone_bundle, args.output_directory)
+         gather.gather(deployed_zone_bundle, args.output_directory, args.deployment_name)
+         try:
+             test_history.record_gathered_test_reports(deployed_zone_bundle, args.output_directory, args.deployment_name)
+         except Exception:
+             logging.getLogger(__name__).exception('failed to record test history')
+         try:
+             log_index.index_gathered_logs(deployed_zone_bundle, args.output_directory, args.deployment_name)
+         except Exception:
+             logging.getLogger(__name__).exception('failed to index the gathered logs')
 
     if not tests_passed:
         sys.exit(1)